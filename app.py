@@ -5,15 +5,39 @@ Version démo pour présentation
 
 import os
 import re
+import sys
 import json
+import copy
+import math
+import time
 import uuid
+import gzip
+import bisect
+import contextvars
+import hashlib
+import hmac
+import unicodedata
+import atexit
 import logging
+import queue
+import asyncio
+import select
+import threading
+import subprocess
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+try:
+    import fcntl
+except ImportError:  # Windows : pas de mode multi-processus
+    fcntl = None
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-import vosk
-import spacy
 from gtts import gTTS
 from pydub import AudioSegment
 from pydub.utils import which
@@ -29,43 +53,343 @@ AudioSegment.converter = which("ffmpeg")
 app = Flask(__name__)
 CORS(app)
 
-# Modèle Vosk
-model_path = r"./tools/vosk-model-fr-0.22"
-if not os.path.exists(model_path):
-    logger.error(f"Modèle Vosk introuvable : {model_path}")
-    model = None
-else:
-    try:
-        model = vosk.Model(model_path)
-        logger.info("Modèle Vosk chargé")
-    except Exception as e:
-        logger.error(f"Erreur chargement Vosk: {e}")
-        model = None
-
 # Répertoire audio
 AUDIO_DIR = "responses"
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
-# Modèle spaCy
-try:
-    nlp = spacy.load("fr_core_news_md")
-    logger.info("Modèle spaCy chargé")
-except Exception as e:
-    logger.error(f"Erreur spaCy: {e}")
-    nlp = None
+# ========== MÉTRIQUES ==========
 
-# ========== BASE DE DONNÉES SIMPLE (fichier JSON) ==========
+# Bornes des histogrammes de latence (secondes)
+METRIQUES_BORNES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-def load_user_data():
-    """Charge les données utilisateur depuis un fichier JSON"""
+# Détail de la requête en cours ({"etapes": [...], "intentions": [...]}) quand elle est suivie, sinon None
+trace_requete = contextvars.ContextVar("trace_requete", default=None)
+
+class Metriques:
+    """Compteurs et histogrammes en mémoire, exposés au format texte Prometheus"""
+
+    def __init__(self, bornes):
+        self.bornes = bornes
+        self._descriptions = {}
+        # (nom, étiquettes) -> valeur, ou [compte par borne..., compte total, somme] pour un histogramme
+        self._series = {}
+        self._collecteurs = []
+        self._verrou = threading.Lock()
+
+    def declarer(self, nom, type_metrique, description):
+        self._descriptions[nom] = (type_metrique, description)
+
+    def incrementer(self, nom, valeur=1, **etiquettes):
+        cle = (nom, tuple(sorted(etiquettes.items())))
+        with self._verrou:
+            self._series[cle] = self._series.get(cle, 0) + valeur
+
+    def observer(self, nom, valeur, **etiquettes):
+        cle = (nom, tuple(sorted(etiquettes.items())))
+        # Bornes cumulées à l'exposition : une seule case incrémentée par observation
+        position = bisect.bisect_left(self.bornes, valeur)
+        with self._verrou:
+            serie = self._series.get(cle)
+            if serie is None:
+                serie = self._series[cle] = [0] * (len(self.bornes) + 2)
+            serie[position] += 1
+            serie[-1] += valeur
+
+    def observer_etape(self, etape, duree):
+        """Durée d'une étape du traitement, ajoutée aussi au détail de la requête suivie"""
+        self.observer("assistant_etape_duree_secondes", duree, etape=etape)
+        trace = trace_requete.get()
+        if trace is not None:
+            trace["etapes"].append({"etape": etape, "duree": round(duree, 6)})
+
+    @contextmanager
+    def mesurer(self, etape):
+        """Chronomètre une étape du traitement (comptée aussi en cas d'exception)"""
+        debut = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observer_etape(etape, time.perf_counter() - debut)
+
+    def collecteur(self, fonction):
+        """Enregistre une fonction lue à l'exposition : [(nom, étiquettes, valeur), ...]"""
+        self._collecteurs.append(fonction)
+        return fonction
+
+    def exposer(self):
+        """Texte au format d'exposition Prometheus 0.0.4"""
+        with self._verrou:
+            series = [(nom, etiquettes, list(v) if isinstance(v, list) else v)
+                      for (nom, etiquettes), v in self._series.items()]
+        for fonction in self._collecteurs:
+            try:
+                series.extend((nom, tuple(sorted(etiquettes.items())), valeur)
+                              for nom, etiquettes, valeur in fonction())
+            except Exception as e:
+                logger.error(f"Erreur collecte métriques: {e}")
+
+        par_nom = {}
+        for nom, etiquettes, valeur in series:
+            par_nom.setdefault(nom, []).append((etiquettes, valeur))
+
+        lignes = []
+        for nom in sorted(par_nom):
+            type_metrique, description = self._descriptions.get(nom, ("untyped", nom))
+            lignes.append(f"# HELP {nom} {description}")
+            lignes.append(f"# TYPE {nom} {type_metrique}")
+            for etiquettes, valeur in sorted(par_nom[nom]):
+                if type_metrique != "histogram":
+                    lignes.append(f"{nom}{formater_etiquettes(etiquettes)} {valeur}")
+                    continue
+                cumul = 0
+                for borne, compte in zip(self.bornes + ("+Inf",), valeur):
+                    cumul += compte
+                    lignes.append(f"{nom}_bucket{formater_etiquettes(etiquettes + (('le', borne),))} {cumul}")
+                lignes.append(f"{nom}_sum{formater_etiquettes(etiquettes)} {valeur[-1]}")
+                lignes.append(f"{nom}_count{formater_etiquettes(etiquettes)} {cumul}")
+        return "\n".join(lignes) + "\n"
+
+def formater_etiquettes(etiquettes):
+    if not etiquettes:
+        return ""
+    valeurs = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in etiquettes)
+    return "{" + ",".join(f'{cle}="{valeur}"' for (cle, _), valeur in zip(etiquettes, valeurs)) + "}"
+
+metriques = Metriques(METRIQUES_BORNES)
+metriques.declarer("assistant_etape_duree_secondes", "histogram",
+                   "Durée de chaque étape du traitement (intention, spacy, gestionnaire, persistance, llm, tts...)")
+metriques.declarer("assistant_requete_duree_secondes", "histogram", "Durée de traitement des requêtes HTTP par route")
+metriques.declarer("assistant_requetes_total", "counter", "Requêtes HTTP par route et code de statut")
+metriques.declarer("assistant_intentions_total", "counter", "Demandes par intention détectée (inconnue : repli LLM)")
+metriques.declarer("assistant_llm_total", "counter", "Appels au LLM par résultat (succes, erreur, refus)")
+metriques.declarer("assistant_erreurs_total", "counter", "Erreurs par étape")
+
+# ========== PROFILAGE ==========
+
+# Requêtes /process* plus lentes que PROFIL_SEUIL secondes consignées avec le détail de leurs étapes (0 : désactivé)
+PROFIL_SEUIL = float(os.environ.get("PROFIL_SEUIL", "2"))
+PROFILS_DIR = "profils"
+PROFIL_FICHIER_LENTES = os.path.join(PROFILS_DIR, "lentes.jsonl")
+PROFIL_FICHIER_MAX_OCTETS = 10 * 1024 * 1024
+# Profilage par échantillonnage à la demande (en-tête X-Profile ou /admin/profilage) : jeton exigé,
+# vide : désactivé ; intervalle entre deux échantillons de pile (s)
+PROFIL_JETON = os.environ.get("PROFIL_JETON", "")
+PROFIL_INTERVALLE = float(os.environ.get("PROFIL_INTERVALLE", "0.005"))
+
+_verrou_profils = threading.Lock()
+
+def route_profilee(chemin):
+    return chemin.startswith("/process")
+
+def nouvelle_trace():
+    return {"etapes": [], "intentions": []}
+
+def consigner_requete_lente(route, methode, statut, duree, trace, profil=None):
+    """Ajoute une requête lente à profils/lentes.jsonl (une ligne JSON, sans le texte de la demande)"""
+    ligne = json.dumps({
+        "date": datetime.now().isoformat(),
+        "route": route,
+        "methode": methode,
+        "statut": statut,
+        "duree": round(duree, 6),
+        "intentions": trace["intentions"],
+        "etapes": trace["etapes"],
+        "profil": profil,
+    }, ensure_ascii=False)
     try:
-        if os.path.exists("users_data.json"):
-            with open("users_data.json", "r", encoding="utf-8") as f:
-                return json.load(f)
-    except Exception as e:
-        logger.error(f"Erreur chargement données: {e}")
-    
-    # Données par défaut
+        with _verrou_profils:
+            os.makedirs(PROFILS_DIR, exist_ok=True)
+            if os.path.exists(PROFIL_FICHIER_LENTES) and os.path.getsize(PROFIL_FICHIER_LENTES) > PROFIL_FICHIER_MAX_OCTETS:
+                os.replace(PROFIL_FICHIER_LENTES, PROFIL_FICHIER_LENTES + ".1")
+            with open(PROFIL_FICHIER_LENTES, "a", encoding="utf-8") as f:
+                f.write(ligne + "\n")
+    except OSError as e:
+        logger.error(f"Erreur écriture requête lente: {e}")
+    if profil is None:
+        logger.warning(f"Requête lente {methode} {route} ({duree:.2f} s)")
+
+class Echantillonneur:
+    """Profileur par échantillonnage de la pile d'un thread ; sortie « folded » (flamegraph.pl, speedscope)"""
+
+    def __init__(self, thread_id, intervalle, route):
+        self.thread_id = thread_id
+        self.intervalle = intervalle
+        # Chemin connu dès le départ : annoncé dans les en-têtes d'un flux avant la fin de l'échantillonnage
+        nom = re.sub(r"[^\w]+", "_", route).strip("_") or "racine"
+        self.chemin = os.path.join(PROFILS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{nom}-{uuid.uuid4().hex[:6]}.folded")
+        # pile "racine;...;feuille" -> nombre d'échantillons
+        self.piles = {}
+        self._arret = threading.Event()
+        self._thread = threading.Thread(target=self._boucle, name="profilage", daemon=True)
+        self._thread.start()
+
+    def _boucle(self):
+        while not self._arret.wait(self.intervalle):
+            frame = sys._current_frames().get(self.thread_id)
+            pile = []
+            while frame is not None:
+                code = frame.f_code
+                pile.append(f"{code.co_name} ({frame.f_globals.get('__name__', '?')}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if pile:
+                cle = ";".join(reversed(pile))
+                self.piles[cle] = self.piles.get(cle, 0) + 1
+
+    def arreter(self):
+        """Arrête l'échantillonnage et écrit les piles dans profils/ ; retourne le chemin du fichier"""
+        self._arret.set()
+        self._thread.join()
+        os.makedirs(PROFILS_DIR, exist_ok=True)
+        with open(self.chemin, "w", encoding="utf-8") as f:
+            for pile, nombre in sorted(self.piles.items()):
+                f.write(f"{pile} {nombre}\n")
+        return self.chemin
+
+# Profilage des prochaines requêtes /process* demandé par /admin/profilage
+_profilages_demandes = 0
+
+def demander_profilage(nombre):
+    global _profilages_demandes
+    with _verrou_profils:
+        _profilages_demandes = nombre
+        return _profilages_demandes
+
+def prendre_profilage():
+    """Consomme une demande de profilage en attente ; False s'il n'y en a pas"""
+    global _profilages_demandes
+    if not _profilages_demandes:
+        return False
+    with _verrou_profils:
+        if _profilages_demandes <= 0:
+            return False
+        _profilages_demandes -= 1
+        return True
+
+def jeton_profilage_valide(jeton):
+    return bool(PROFIL_JETON) and jeton is not None and hmac.compare_digest(jeton, PROFIL_JETON)
+
+# ========== MODÈLES (chargement différé) ==========
+
+VOSK_MODEL_PATH = r"./tools/vosk-model-fr-0.22"
+SPACY_MODELE = "fr_core_news_md"
+# Composants spaCy inutiles ici : seule la NER sert (extraire_destinataire), les vecteurs restent dans le vocabulaire
+SPACY_COMPOSANTS_EXCLUS = [c for c in os.environ.get(
+    "SPACY_COMPOSANTS_EXCLUS", "parser,morphologizer,attribute_ruler,lemmatizer,senter").split(",") if c]
+# Modèles chargés en arrière-plan dès le démarrage ; les autres le sont à leur première utilisation
+MODELES_PRECHARGES = [m for m in os.environ.get("MODELES_PRECHARGES", "spacy").split(",") if m]
+
+def memoire_residente():
+    """Mémoire résidente du processus (octets)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RegistreModeles:
+    """Registre des modèles : chargement unique, à la demande ou en arrière-plan"""
+
+    def __init__(self):
+        self._modeles = {}
+
+    def enregistrer(self, nom, chargeur):
+        """Déclare un modèle et sa fonction de chargement"""
+        self._modeles[nom] = {
+            "chargeur": chargeur,
+            "modele": None,
+            "etat": "not_loaded",
+            "erreur": None,
+            "duree_chargement_s": None,
+            "memoire_mo": None,
+            "verrou": threading.Lock(),
+        }
+
+    def obtenir(self, nom):
+        """Retourne le modèle, en le chargeant si besoin (None en cas d'échec)"""
+        entree = self._modeles[nom]
+        if entree["etat"] in ("ready", "error"):
+            return entree["modele"]
+
+        with entree["verrou"]:
+            if entree["etat"] not in ("ready", "error"):
+                entree["etat"] = "loading"
+                debut, memoire_avant = time.perf_counter(), memoire_residente()
+                try:
+                    entree["modele"] = entree["chargeur"]()
+                    entree["etat"] = "ready"
+                    logger.info(f"Modèle {nom} chargé")
+                except Exception as e:
+                    logger.error(f"Erreur chargement {nom}: {e}")
+                    entree["erreur"] = str(e)
+                    entree["etat"] = "error"
+                entree["duree_chargement_s"] = round(time.perf_counter() - debut, 3)
+                entree["memoire_mo"] = round((memoire_residente() - memoire_avant) / 1e6, 1)
+        return entree["modele"]
+
+    def disponible(self, nom):
+        """Retourne le modèle s'il est déjà chargé, sans jamais attendre"""
+        entree = self._modeles[nom]
+        return entree["modele"] if entree["etat"] == "ready" else None
+
+    def prechauffer(self, noms):
+        """Charge les modèles dans un thread d'arrière-plan"""
+        def charger():
+            for nom in noms:
+                self.obtenir(nom)
+        threading.Thread(target=charger, name="modeles-prechargement", daemon=True).start()
+
+    def etat(self):
+        """État de chaque modèle pour /health"""
+        return {
+            nom: {cle: entree[cle] for cle in ("etat", "erreur", "duree_chargement_s", "memoire_mo")}
+            for nom, entree in self._modeles.items()
+        }
+
+def charger_vosk():
+    """Charge le modèle de reconnaissance vocale Vosk"""
+    if not os.path.exists(VOSK_MODEL_PATH):
+        raise FileNotFoundError(f"Modèle Vosk introuvable : {VOSK_MODEL_PATH}")
+    import vosk
+    return vosk.Model(VOSK_MODEL_PATH)
+
+def charger_spacy():
+    """Charge spaCy sans les composants inutilisés"""
+    import spacy
+    return spacy.load(SPACY_MODELE, exclude=SPACY_COMPOSANTS_EXCLUS)
+
+modeles = RegistreModeles()
+modeles.enregistrer("vosk", charger_vosk)
+modeles.enregistrer("spacy", charger_spacy)
+modeles.prechauffer(MODELES_PRECHARGES)
+
+# ========== BASE DE DONNÉES (comptes répartis par shards) ==========
+
+# Ancien fichier unique, migré vers les shards au premier démarrage
+DATA_FILE = "users_data.json"
+JOURNAL_FILE = "users_journal.log"
+# Un fichier JSON par shard ; seuls les shards utilisés récemment restent en mémoire
+USERS_DIR = "users"
+USERS_META_FILE = os.path.join(USERS_DIR, "meta.json")
+USERS_SHARDS = int(os.environ.get("USERS_SHARDS", "64"))
+USERS_SHARDS_EN_MEMOIRE = int(os.environ.get("USERS_SHARDS_EN_MEMOIRE", "16"))
+
+# Mode de stockage : "journal" (journal append-only + écriture différée des shards), "json" (écriture
+# immédiate du shard) ou "partage" (json + verrou de fichier par shard, pour plusieurs processus)
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "journal")
+MULTI_PROCESSUS = STORAGE_MODE == "partage"
+if MULTI_PROCESSUS and fcntl is None:
+    raise RuntimeError("STORAGE_MODE=partage nécessite fcntl (Linux, macOS)")
+# Nombre d'opérations journalisées avant un snapshot compacté
+JOURNAL_SNAPSHOT_INTERVAL = int(os.environ.get("JOURNAL_SNAPSHOT_INTERVAL", "500"))
+# Fenêtre d'attente (ms) pour regrouper plusieurs opérations dans un même fsync
+JOURNAL_GROUP_COMMIT_MS = float(os.environ.get("JOURNAL_GROUP_COMMIT_MS", "2"))
+
+# Champs du compte recopiés dans chaque entrée du journal
+CHAMPS_SOLDES = ("solde_principal", "credit_communication", "internet_mb", "bonus_fidelite")
+
+def donnees_par_defaut():
+    """Données utilisateur par défaut"""
     return {
         "users": {
             "default": {
@@ -81,55 +405,832 @@ def load_user_data():
         }
     }
 
-def save_user_data(data):
-    """Sauvegarde les données utilisateur"""
+def appliquer_entree_journal(user_id, user, entree):
+    """Rejoue une entrée du journal sur un compte (idempotent)"""
+    # Le compte enregistre le dernier numéro de journal appliqué : une entrée déjà présente dans
+    # le shard écrit (snapshot, éviction) n'est pas rejouée
+    if "journal_seq" in user:
+        if entree["seq"] <= user["journal_seq"]:
+            return
+        deja_vue = False
+    else:
+        # Compte écrit avant l'introduction de journal_seq
+        transaction = entree.get("transaction")
+        deja_vue = bool(transaction) and any(t["id"] == transaction["id"] for t in user["transactions"][-50:])
+    user.update(entree["champs"])
+    user["journal_seq"] = entree["seq"]
+
+    transaction = entree.get("transaction")
+    if transaction and not deja_vue:
+        ajouter_transaction(user_id, user, transaction)
+
+def lire_journal(seq_depart):
+    """Entrées du journal postérieures à seq_depart, dans l'ordre"""
+    # L'ancien segment existe si un snapshot a été interrompu
+    for chemin in (JOURNAL_FILE + ".old", JOURNAL_FILE):
+        if not os.path.exists(chemin):
+            continue
+        with open(chemin, "r", encoding="utf-8") as f:
+            for ligne in f:
+                try:
+                    entree = json.loads(ligne)
+                except ValueError:
+                    # Dernière ligne tronquée par un arrêt brutal
+                    logger.warning(f"Entrée de journal illisible ignorée dans {chemin}")
+                    continue
+                if entree["seq"] > seq_depart:
+                    yield entree
+
+def load_user_data():
+    """Charge l'ancien fichier unique (dernier snapshot + fin du journal), pour la migration"""
+    data = None
     try:
-        with open("users_data.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return True
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
     except Exception as e:
-        logger.error(f"Erreur sauvegarde: {e}")
-        return False
+        logger.error(f"Erreur chargement données: {e}")
+
+    if data is None:
+        data = donnees_par_defaut()
+
+    users = data["users"]
+    for entree in lire_journal(data.get("journal_seq", 0)):
+        data["journal_seq"] = entree["seq"]
+        if entree["user_id"] not in users:
+            logger.error(f"Journal seq {entree['seq']} : compte {entree['user_id']} introuvable, entrée non rejouée")
+            continue
+        appliquer_entree_journal(entree["user_id"], users[entree["user_id"]], entree)
+    return data
+
+def ecrire_json_atomique(chemin, data):
+    """Écrit un fichier JSON compact de manière atomique"""
+    chemin_tmp = chemin + ".tmp"
+    with open(chemin_tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(chemin_tmp, chemin)
+
+class DepotUtilisateurs:
+    """Comptes répartis par hachage dans des shards, chargés à la demande dans un LRU borné"""
+
+    def __init__(self, dossier, nb_shards, shards_max):
+        self.dossier = dossier
+        self.nb_shards = nb_shards
+        self.shards_max = shards_max
+        # numéro -> {"users": dict, "epingles": int, "modifie": bool} ; ordre LRU
+        self._shards = OrderedDict()
+        self._verrou = threading.Lock()
+        # Un verrou par shard : chargement, écriture et éviction d'un même shard sont exclusifs
+        self._verrous_shards = [threading.Lock() for _ in range(nb_shards)]
+        # Identité du fichier de chaque shard lors de sa dernière lecture/écriture par ce processus
+        self._versions = {}
+
+    def numero_shard(self, user_id):
+        """Shard d'un compte (hachage stable)"""
+        return int(hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:8], 16) % self.nb_shards
+
+    def chemin_shard(self, num):
+        return os.path.join(self.dossier, f"shard_{num:03d}.json")
+
+    def _lire_shard(self, num):
+        chemin = self.chemin_shard(num)
+        if not os.path.exists(chemin):
+            self._versions[num] = None
+            return {}
+        with open(chemin, "r", encoding="utf-8") as f:
+            self._versions[num] = self.version_fichier(num)
+            return json.load(f)
+
+    def version_fichier(self, num):
+        """Identité du fichier d'un shard (remplacé à chaque écriture, donc nouvel inode)"""
+        try:
+            stat = os.stat(self.chemin_shard(num))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def verrou_fichier(self, num):
+        """Verrou exclusif d'un shard entre processus (et entre threads : un descripteur par appel)"""
+        with open(self.chemin_shard(num) + ".lock", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def rafraichir(self, num):
+        """Relit un shard en mémoire si un autre processus l'a réécrit (sous verrou_fichier)"""
+        with self._verrous_shards[num]:
+            with self._verrou:
+                shard = self._shards.get(num)
+            if shard is None or self._versions.get(num) == self.version_fichier(num):
+                return
+            users = self._lire_shard(num)
+            with self._verrou:
+                shard["users"] = users
+                shard["modifie"] = False
+
+    @contextmanager
+    def acces_partage(self, user_id):
+        """Épingle un compte sous le verrou de fichier de son shard, à jour des écritures des autres processus"""
+        num = self.numero_shard(user_id)
+        with self.verrou_fichier(num):
+            self.rafraichir(num)
+            num_effectif, user_id_effectif = self.epingler(user_id)
+            if user_id_effectif == user_id:
+                try:
+                    yield num, user_id
+                finally:
+                    self.desepingler(num)
+                return
+            self.desepingler(num_effectif)
+        # Compte inconnu : compte par défaut, sous le verrou de son propre shard
+        with self.acces_partage("default") as epingle:
+            yield epingle
+
+    def epingler(self, user_id):
+        """Charge le shard d'un compte et l'empêche d'être évincé ; retourne (num, user_id effectif)"""
+        num = self.numero_shard(user_id)
+        shard = self._epingler_shard(num)
+        if user_id in shard["users"]:
+            return num, user_id
+        # Compte inconnu : compte par défaut
+        self.desepingler(num)
+        return self.epingler("default") if user_id != "default" else (num, user_id)
+
+    def _epingler_shard(self, num):
+        with self._verrou:
+            shard = self._shards.get(num)
+            if shard is not None:
+                shard["epingles"] += 1
+                self._shards.move_to_end(num)
+                return shard
+
+        with self._verrous_shards[num]:
+            with self._verrou:
+                shard = self._shards.get(num)
+                if shard is not None:
+                    shard["epingles"] += 1
+                    self._shards.move_to_end(num)
+                    return shard
+            users = self._lire_shard(num)
+            with self._verrou:
+                shard = {"users": users, "epingles": 1, "modifie": False}
+                self._shards[num] = shard
+        self._evincer()
+        return shard
+
+    def existe(self, user_id):
+        """Vrai si le compte figure dans son shard (chargé au besoin)"""
+        num = self.numero_shard(user_id)
+        shard = self._epingler_shard(num)
+        try:
+            return user_id in shard["users"]
+        finally:
+            self.desepingler(num)
+
+    def resoudre_epingle(self, user_id):
+        """(num, user_id effectif) d'un compte dont le shard est déjà épinglé, sans chargement"""
+        num = self.numero_shard(user_id)
+        with self._verrou:
+            shard = self._shards.get(num)
+            if shard is not None and user_id in shard["users"]:
+                return num, user_id
+        return self.numero_shard("default"), "default"
+
+    def desepingler(self, num):
+        with self._verrou:
+            self._shards[num]["epingles"] -= 1
+
+    def utilisateur(self, num, user_id):
+        """Compte d'un shard épinglé"""
+        return self._shards[num]["users"][user_id]
+
+    def creer(self, user_id, user):
+        """Ajoute un compte (migration, création)"""
+        num = self.numero_shard(user_id)
+        shard = self._epingler_shard(num)
+        shard["users"][user_id] = user
+        self.marquer_modifie(num)
+        self.desepingler(num)
+
+    def marquer_modifie(self, num):
+        with self._verrou:
+            self._shards[num]["modifie"] = True
+
+    def _evincer(self):
+        """Évince les shards les moins récemment utilisés (non épinglés) au-delà de la limite"""
+        while True:
+            with self._verrou:
+                if len(self._shards) <= self.shards_max:
+                    return
+                victime = next((num for num, s in self._shards.items() if s["epingles"] == 0), None)
+            if victime is None:
+                return
+            with self._verrous_shards[victime]:
+                with self._verrou:
+                    shard = self._shards.get(victime)
+                    if shard is None or shard["epingles"]:
+                        continue
+                    del self._shards[victime]
+                if shard["modifie"]:
+                    self._ecrire(victime, shard)
+
+    def _ecrire(self, num, shard):
+        """Écrit un shard (appelée sous le verrou du shard) ; chaque compte est copié sous son verrou"""
+        with self._verrou:
+            shard["modifie"] = False
+            user_ids = list(shard["users"])
+        copie = {}
+        for user_id in user_ids:
+            with verrou_utilisateur(user_id):
+                copie[user_id] = copy.deepcopy(shard["users"][user_id])
+        ecrire_json_atomique(self.chemin_shard(num), copie)
+        self._versions[num] = self.version_fichier(num)
+
+    def ecrire_si_modifie(self, num):
+        """Écrit un shard s'il a été modifié depuis sa dernière écriture"""
+        with self._verrou:
+            shard = self._shards.get(num)
+            if shard is None or not shard["modifie"]:
+                return True
+        with self._verrous_shards[num]:
+            with self._verrou:
+                shard = self._shards.get(num)
+                if shard is None or not shard["modifie"]:
+                    return True
+            try:
+                self._ecrire(num, shard)
+                return True
+            except Exception as e:
+                logger.error(f"Erreur sauvegarde shard {num}: {e}")
+                self.marquer_modifie(num)
+                return False
+
+    def ecrire_modifies(self):
+        """Écrit uniquement les shards modifiés"""
+        with self._verrou:
+            modifies = [num for num, shard in self._shards.items() if shard["modifie"]]
+        for num in modifies:
+            self.ecrire_si_modifie(num)
+        return len(modifies)
+
+    def statistiques(self):
+        with self._verrou:
+            return {"shards": self.nb_shards, "shards_en_memoire": len(self._shards),
+                    "comptes_en_memoire": sum(len(s["users"]) for s in self._shards.values())}
+
+def lire_meta():
+    """Métadonnées du stockage (dernier numéro de journal inclus dans les shards)"""
+    if os.path.exists(USERS_META_FILE):
+        with open(USERS_META_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+def ecrire_meta(journal_seq):
+    """Enregistre les métadonnées ; le nombre de shards y figure car il fixe la place de chaque compte"""
+    ecrire_json_atomique(USERS_META_FILE, {"journal_seq": journal_seq, "nb_shards": USERS_SHARDS})
+
+def initialiser_depot():
+    """Ouvre le dépôt : migration de l'ancien fichier unique, puis rejeu de la fin du journal"""
+    os.makedirs(USERS_DIR, exist_ok=True)
+    depot = DepotUtilisateurs(USERS_DIR, USERS_SHARDS, USERS_SHARDS_EN_MEMOIRE)
+    meta = lire_meta()
+
+    if meta is None:
+        data = load_user_data()
+        for user_id, user in data["users"].items():
+            depot.creer(user_id, user)
+        depot.ecrire_modifies()
+        meta = {"journal_seq": data.get("journal_seq", 0)}
+        ecrire_meta(meta["journal_seq"])
+        if os.path.exists(DATA_FILE):
+            os.replace(DATA_FILE, DATA_FILE + ".migre")
+        logger.info(f"{len(data['users'])} comptes migrés vers {USERS_DIR}/")
+        return depot, meta["journal_seq"]
+
+    # Un autre nombre de shards rendrait les comptes introuvables : les shards ne sont pas redistribués
+    nb_shards = meta.get("nb_shards")
+    if nb_shards is None:
+        # Dépôt créé avant l'enregistrement du nombre de shards : la configuration courante fait foi
+        ecrire_meta(meta["journal_seq"])
+    elif nb_shards != USERS_SHARDS:
+        raise RuntimeError(f"USERS_SHARDS={USERS_SHARDS} mais {USERS_DIR}/ a été créé avec {nb_shards} shards : "
+                           f"relancez avec USERS_SHARDS={nb_shards}")
+
+    seq = meta["journal_seq"]
+    rejouees = 0
+    for entree in lire_journal(seq):
+        num, user_id = depot.epingler(entree["user_id"])
+        if user_id != entree["user_id"]:
+            # Jamais sur le compte par défaut : ce serait appliquer les soldes d'un autre compte
+            depot.desepingler(num)
+            logger.error(f"Journal seq {entree['seq']} : compte {entree['user_id']} introuvable, entrée non rejouée")
+            seq = entree["seq"]
+            continue
+        appliquer_entree_journal(user_id, depot.utilisateur(num, user_id), entree)
+        depot.marquer_modifie(num)
+        depot.desepingler(num)
+        seq = entree["seq"]
+        rejouees += 1
+    if rejouees:
+        logger.info(f"{rejouees} opérations rejouées depuis le journal")
+    return depot, seq
+
+class JournalTransactions:
+    """Journal append-only avec commit groupé (un fsync pour plusieurs opérations)"""
+
+    def __init__(self, chemin, seq_initial=0):
+        self.chemin = chemin
+        self._cond = threading.Condition()
+        self._tampon = []
+        self._seq = seq_initial
+        self._seq_durable = seq_initial
+        self._seq_snapshot = seq_initial
+        self._erreur_seq = 0
+        self._fichier = open(chemin, "a", encoding="utf-8")
+        self._snapshot_demande = threading.Event()
+        self._demarrer()
+        # Processus forké (gunicorn preload_app) : les threads du parent n'existent pas dans l'enfant
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._apres_fork)
+
+    def _demarrer(self):
+        threading.Thread(target=self._boucle_ecriture, name="journal-ecriture", daemon=True).start()
+        threading.Thread(target=self._boucle_snapshot, name="journal-snapshot", daemon=True).start()
+
+    def _apres_fork(self):
+        self._cond = threading.Condition()
+        self._snapshot_demande = threading.Event()
+        self._demarrer()
+
+    def ajouter(self, entree):
+        """Ajoute une entrée (numérotée dans entree["seq"]) et attend qu'elle soit durable sur disque"""
+        with self._cond:
+            self._seq += 1
+            seq = entree["seq"] = self._seq
+            self._tampon.append(json.dumps(entree, ensure_ascii=False) + "\n")
+            self._cond.notify_all()
+
+            while self._seq_durable < seq and self._erreur_seq < seq:
+                self._cond.wait()
+            ok = self._seq_durable >= seq
+
+        if seq - self._seq_snapshot >= JOURNAL_SNAPSHOT_INTERVAL:
+            self._snapshot_demande.set()
+        return ok
+
+    def _boucle_ecriture(self):
+        """Thread d'écriture : vide le tampon par lots, un fsync par lot"""
+        while True:
+            with self._cond:
+                while not self._tampon:
+                    self._cond.wait()
+
+            # Laisse le temps aux requêtes concurrentes de rejoindre le lot
+            if JOURNAL_GROUP_COMMIT_MS > 0:
+                time.sleep(JOURNAL_GROUP_COMMIT_MS / 1000)
+
+            with self._cond:
+                lignes, self._tampon = self._tampon, []
+                dernier_seq = self._seq
+                fichier = self._fichier
+
+            try:
+                fichier.write("".join(lignes))
+                fichier.flush()
+                os.fsync(fichier.fileno())
+                with self._cond:
+                    self._seq_durable = dernier_seq
+                    self._cond.notify_all()
+            except Exception as e:
+                logger.error(f"Erreur écriture journal: {e}")
+                with self._cond:
+                    self._erreur_seq = dernier_seq
+                    self._cond.notify_all()
+
+    def _boucle_snapshot(self):
+        """Thread de compaction : écriture des shards puis suppression de l'ancien segment"""
+        while True:
+            self._snapshot_demande.wait()
+            self._snapshot_demande.clear()
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Erreur snapshot: {e}")
+
+    def snapshot(self):
+        """Écrit les shards modifiés, enregistre le numéro atteint et tronque le journal"""
+        chemin_old = self.chemin + ".old"
+        with self._cond:
+            # Attend que le tampon soit écrit avant de changer de segment
+            while self._tampon or self._seq_durable < self._seq:
+                if self._erreur_seq >= self._seq:
+                    break
+                self._cond.wait()
+            seq = self._seq_durable
+            self._fichier.close()
+            os.replace(self.chemin, chemin_old)
+            self._fichier = open(self.chemin, "a", encoding="utf-8")
+
+        # Les entrées > seq éventuellement visibles dans les shards sont rejouées sans effet
+        ecrits = depot.ecrire_modifies()
+        ecrire_meta(seq)
+        os.remove(chemin_old)
+        self._seq_snapshot = seq
+        logger.info(f"Snapshot écrit (seq {seq}, {ecrits} shards)")
+
+    def fermer(self):
+        """Vide le journal avant l'arrêt"""
+        with self._cond:
+            while self._tampon and self._erreur_seq < self._seq:
+                self._cond.wait(timeout=1)
+            self._fichier.close()
+
+# ========== CONCURRENCE ==========
+
+# Verrous répartis par hachage de l'identifiant : les opérations de comptes différents restent
+# parallèles, et la mémoire utilisée ne dépend pas du nombre de comptes
+NB_VERROUS_COMPTES = 1024
+_verrous_comptes = [threading.RLock() for _ in range(NB_VERROUS_COMPTES)]
+
+def verrou_utilisateur(user_id):
+    """Retourne le verrou d'un compte"""
+    return _verrous_comptes[hash(user_id) % NB_VERROUS_COMPTES]
+
+@contextmanager
+def acces_utilisateur(user_id="default"):
+    """Accès exclusif au compte pendant une séquence lecture-vérification-écriture"""
+    if MULTI_PROCESSUS:
+        # Le verrou de fichier du shard couvre la lecture, l'opération et l'écriture
+        with depot.acces_partage(user_id) as (num, user_id):
+            with verrou_utilisateur(user_id):
+                yield depot.utilisateur(num, user_id)
+            with metriques.mesurer("persistance"):
+                depot.ecrire_si_modifie(num)
+        return
+
+    num, user_id = depot.epingler(user_id)
+    try:
+        with verrou_utilisateur(user_id):
+            yield depot.utilisateur(num, user_id)
+        # Mode json : le shard modifié est écrit dès la fin de l'opération, hors verrou du compte
+        if journal is None:
+            with metriques.mesurer("persistance"):
+                depot.ecrire_si_modifie(num)
+    finally:
+        depot.desepingler(num)
 
-# Chargement initial des données
-user_database = load_user_data()
+# ========== HISTORIQUE DES TRANSACTIONS ==========
+
+# Transactions gardées dans le compte ; les plus anciennes partent en archive par lots
+HISTORIQUE_CHAUD_MAX = int(os.environ.get("HISTORIQUE_CHAUD_MAX", "200"))
+HISTORIQUE_LOT_ARCHIVE = 50
+ARCHIVES_DIR = "archives"
+
+TYPES_TRANSACTIONS = ("transfert", "recharge_credit", "achat_internet", "bonus_fidelite")
+# Types qui créditent le compte (les autres sont des dépenses)
+TYPES_CREDITS = ("bonus_fidelite",)
+
+class IndexHistorique:
+    """Index en mémoire des transactions récentes d'un compte, par type et par date"""
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.dates = []
+        self.par_type = {}
+        for transaction in transactions:
+            self.ajouter(transaction)
+
+    def valide(self, transactions):
+        """Vrai si l'index décrit toujours cette liste (sinon elle a été archivée ou remplacée)"""
+        if transactions is not self.transactions or len(transactions) != len(self.dates):
+            return False
+        return not transactions or transactions[-1]["date"] == self.dates[-1]
+
+    def ajouter(self, transaction):
+        """Indexe une transaction ajoutée en fin de liste"""
+        self.par_type.setdefault(transaction["type"], []).append(len(self.dates))
+        self.dates.append(transaction["date"])
+
+    def chercher(self, type_transaction=None, debut=None, fin=None):
+        """Positions (ordre chronologique) des transactions filtrées ; dates ISO, fin exclue"""
+        gauche = bisect.bisect_left(self.dates, debut) if debut else 0
+        droite = bisect.bisect_left(self.dates, fin) if fin else len(self.dates)
+        if type_transaction is None:
+            return list(range(gauche, droite))
+        positions = self.par_type.get(type_transaction, [])
+        return positions[bisect.bisect_left(positions, gauche):bisect.bisect_left(positions, droite)]
+
+_index_historiques = OrderedDict()
+_verrou_index_historiques = threading.Lock()
+INDEX_HISTORIQUES_MAX = 1000
+
+def index_historique(user_id, user):
+    """Index de l'historique récent d'un compte (appelée sous le verrou du compte)"""
+    with _verrou_index_historiques:
+        index = _index_historiques.get(user_id)
+        if index is not None:
+            _index_historiques.move_to_end(user_id)
+    if index is None or not index.valide(user["transactions"]):
+        index = IndexHistorique(user["transactions"])
+        with _verrou_index_historiques:
+            _index_historiques[user_id] = index
+            while len(_index_historiques) > INDEX_HISTORIQUES_MAX:
+                _index_historiques.popitem(last=False)
+    return index
+
+def periode(date_iso):
+    """Période d'agrégation d'une date (mois)"""
+    return date_iso[:7]
+
+def debut_periode(mois):
+    """Premier instant d'une période, au format des dates enregistrées"""
+    return f"{mois}-01T00:00:00"
+
+def periode_recoupee(mois, debut=None, fin=None):
+    """Vrai si la période recoupe [debut, fin[ (fin exclue : un mois qui commence à fin n'en fait pas partie)"""
+    return (not debut or mois >= periode(debut)) and (not fin or debut_periode(mois) < fin)
+
+def periode_entiere(mois, debut=None, fin=None):
+    """Vrai si toute la période est dans [debut, fin["""
+    return (not debut or debut <= debut_periode(mois)) and (not fin or mois < periode(fin))
+
+def cumuler(agregats, transaction):
+    """Ajoute une transaction aux agrégats par période et par type"""
+    cumul = agregats.setdefault(periode(transaction["date"]), {}).setdefault(
+        transaction["type"], {"nombre": 0, "montant": 0, "frais": 0})
+    cumul["nombre"] += 1
+    cumul["montant"] += transaction["montant"]
+    cumul["frais"] += transaction.get("frais", 0)
+
+def agregats_utilisateur(user):
+    """Agrégats du compte (recalculés pour un compte créé avant leur introduction)"""
+    if "agregats" not in user:
+        agregats = {}
+        for transaction in user["transactions"]:
+            cumuler(agregats, transaction)
+        user["agregats"] = agregats
+    return user["agregats"]
+
+def dossier_archives(user_id):
+    """Dossier d'archive d'un compte (nom dérivé de l'identifiant)"""
+    return os.path.join(ARCHIVES_DIR, hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:16])
+
+def archiver(user_id, transactions):
+    """Ajoute des transactions à l'archive compressée du compte, un fichier par mois"""
+    dossier = dossier_archives(user_id)
+    os.makedirs(dossier, exist_ok=True)
+    par_mois = {}
+    for transaction in transactions:
+        par_mois.setdefault(periode(transaction["date"]), []).append(transaction)
+    for mois, lignes in par_mois.items():
+        # gzip accepte l'ajout de membres successifs dans un même fichier
+        with gzip.open(os.path.join(dossier, f"{mois}.jsonl.gz"), "at", encoding="utf-8") as f:
+            for transaction in lignes:
+                f.write(json.dumps(transaction, ensure_ascii=False) + "\n")
+
+def lire_archive_mois(user_id, mois):
+    """Transactions archivées d'un mois, dans l'ordre d'archivage (un lot archivé deux fois
+    après un arrêt brutal n'y figure qu'une fois)"""
+    chemin = os.path.join(dossier_archives(user_id), f"{mois}.jsonl.gz")
+    if not os.path.exists(chemin):
+        return []
+    transactions = {}
+    with gzip.open(chemin, "rt", encoding="utf-8") as f:
+        for ligne in f:
+            transaction = json.loads(ligne)
+            transactions.setdefault(transaction["id"], transaction)
+    return list(transactions.values())
+
+def archives_recentes(user_id, debut=None, fin=None):
+    """Transactions archivées des mois qui recoupent [debut, fin[, des plus récentes aux plus anciennes,
+    décompressées mois par mois au fur et à mesure de la lecture"""
+    dossier = dossier_archives(user_id)
+    if not os.path.isdir(dossier):
+        return
+    for nom in sorted(os.listdir(dossier), reverse=True):
+        mois = nom.split(".")[0]
+        if periode_recoupee(mois, debut, fin):
+            yield from reversed(lire_archive_mois(user_id, mois))
+
+def compte_effectif(user_id):
+    """Identifiant du compte réellement utilisé, shard épinglé (un compte inconnu retombe sur default)"""
+    return depot.resoudre_epingle(user_id)[1]
+
+def compte_demande(valeur):
+    """Compte visé par une requête : default si user_id est omis, None si l'identifiant fourni est inconnu
+    (une faute de frappe ne doit jamais débiter le compte par défaut)"""
+    if valeur is None:
+        return "default"
+    if not isinstance(valeur, str) or not depot.existe(valeur):
+        return None
+    return valeur
+
+# Référence de la dernière transaction enregistrée par le thread courant (résultats idempotents de /process)
+contexte_transaction = threading.local()
+
+def ajouter_transaction(user_id, user, transaction):
+    """Enregistre une transaction : liste récente, agrégats, archivage (appelée sous le verrou du compte)"""
+    contexte_transaction.reference = transaction["id"]
+    cumuler(agregats_utilisateur(user), transaction)
+    user["transactions"].append(transaction)
+
+    if len(user["transactions"]) > HISTORIQUE_CHAUD_MAX:
+        nombre = len(user["transactions"]) - HISTORIQUE_CHAUD_MAX + HISTORIQUE_LOT_ARCHIVE
+        archiver(user_id, user["transactions"][:nombre])
+        del user["transactions"][:nombre]
+        return
+
+    # L'index déjà construit est complété ; après un archivage il sera reconstruit à la demande
+    with _verrou_index_historiques:
+        index = _index_historiques.get(user_id)
+    if index is not None and index.transactions is user["transactions"] \
+            and len(index.dates) == len(user["transactions"]) - 1:
+        index.ajouter(transaction)
+
+def consulter_historique(user_id="default", type_transaction=None, debut=None, fin=None,
+                         page=1, taille=20, archives=True):
+    """Page de l'historique filtré (plus récentes d'abord) avec les agrégats mensuels de la période"""
+    with acces_utilisateur(user_id) as user:
+        user_id = compte_effectif(user_id)
+        index = index_historique(user_id, user)
+        transactions = [user["transactions"][p] for p in index.chercher(type_transaction, debut, fin)]
+        # Après un arrêt brutal, le dernier lot archivé peut être encore en tête de la liste récente
+        ids_recents = {t["id"] for t in user["transactions"]}
+        agregats = {
+            mois: copy.deepcopy(cumuls)
+            for mois, cumuls in agregats_utilisateur(user).items()
+            if periode_recoupee(mois, debut, fin)
+        }
+
+    def retenue(transaction):
+        return ((not debut or transaction["date"] >= debut) and (not fin or transaction["date"] < fin)
+                and (type_transaction is None or transaction["type"] == type_transaction))
+
+    transactions.reverse()
+    depart = (page - 1) * taille
+    page_transactions = transactions[depart:depart + taille]
+    total = len(transactions)
+    if archives:
+        # Les archives sont exactement le début de la liste : aucun tri par date entre les deux
+        # (l'horloge peut reculer), seuls les doublons d'identifiant sont écartés.
+        # Elles ne sont lues que si la page va au-delà des transactions récentes retenues.
+        if depart + taille > len(transactions):
+            anciennes = (t for t in archives_recentes(user_id, debut, fin)
+                         if retenue(t) and t["id"] not in ids_recents)
+            page_transactions += islice(anciennes, max(0, depart - len(transactions)),
+                                        depart + taille - len(transactions))
+        # Total : mois entiers comptés par les agrégats (liste récente et archives),
+        # mois entamés par debut ou fin comptés un par un
+        total = 0
+        for mois, cumuls in agregats.items():
+            if periode_entiere(mois, debut, fin):
+                total += sum(cumul["nombre"] for type_cumul, cumul in cumuls.items()
+                             if type_transaction is None or type_cumul == type_transaction)
+            else:
+                total += sum(1 for t in transactions if periode(t["date"]) == mois)
+                total += sum(1 for t in lire_archive_mois(user_id, mois)
+                             if retenue(t) and t["id"] not in ids_recents)
+
+    totaux = {}
+    for cumuls in agregats.values():
+        for type_cumul, cumul in cumuls.items():
+            if type_transaction is None or type_cumul == type_transaction:
+                somme = totaux.setdefault(type_cumul, {"nombre": 0, "montant": 0, "frais": 0})
+                for champ in somme:
+                    somme[champ] += cumul[champ]
+
+    return {
+        "total": total,
+        "page": page,
+        "taille": taille,
+        "transactions": page_transactions,
+        "agregats": agregats,
+        "totaux": totaux,
+    }
+
+@contextmanager
+def verrou_initialisation():
+    """Mode partage : un seul processus à la fois migre ou rejoue le journal"""
+    if not MULTI_PROCESSUS:
+        yield
+        return
+    os.makedirs(USERS_DIR, exist_ok=True)
+    with open(os.path.join(USERS_DIR, "init.lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# Chargement initial : seuls le compte par défaut et les comptes du journal sont lus
+with verrou_initialisation():
+    depot, seq_journal = initialiser_depot()
+    if STORAGE_MODE != "journal":
+        # Modes json et partage : les opérations rejouées sont écrites tout de suite
+        depot.ecrire_modifies()
+
+journal = None
+if STORAGE_MODE == "journal":
+    journal = JournalTransactions(JOURNAL_FILE, seq_journal)
+    atexit.register(journal.fermer)
+
+def enregistrer_operation(user_id, user, transaction):
+    """Persiste une opération selon le mode de stockage (appelée sous le verrou du compte)"""
+    num, user_id = depot.resoudre_epingle(user_id)
+    # Marqué avant la journalisation : un snapshot ne peut pas tronquer l'entrée sans écrire le shard
+    depot.marquer_modifie(num)
+    if journal is None:
+        # Le shard est écrit à la sortie de acces_utilisateur
+        return True
+
+    entree = {
+        "user_id": user_id,
+        "champs": {champ: user[champ] for champ in CHAMPS_SOLDES},
+        "transaction": transaction,
+    }
+    with metriques.mesurer("persistance"):
+        ok = journal.ajouter(entree)
+    # Numéro écrit avec le compte : le rejeu ignore les entrées déjà incluses dans le shard
+    user["journal_seq"] = entree["seq"]
+    return ok
 
 # ========== FONCTIONS UTILITAIRES ==========
 
+# Motifs d'extraction compilés une fois pour toutes
+REGEX_MONTANTS = [
+    re.compile(r'(\d+(?:\s*\d+)*)\s*(?:francs?|fcfa|f\b)'),
+    re.compile(r'(\d+(?:\s*\d+)*)'),  # Nombre simple
+]
+REGEX_ESPACES = re.compile(r'\s+')
+REGEX_TELEPHONE = re.compile(r'(\d{8})')
+REGEX_NOM_APRES_A = re.compile(r'\bà\s+([A-Za-zÀ-ÿ\s]+)')
+
+# Personnes reconnues par spaCy pour les phrases récentes (une phrase répétée n'est analysée qu'une fois)
+NLP_CACHE_TAILLE = int(os.environ.get("NLP_CACHE_TAILLE", "2048"))
+_cache_personnes = OrderedDict()
+_verrou_cache_personnes = threading.Lock()
+
 def extraire_montant(texte):
     """Extrait un montant du texte"""
-    # Cherche les patterns de montant
-    patterns = [
-        r'(\d+(?:\s*\d+)*)\s*(?:francs?|fcfa|f\b)',
-        r'(\d+(?:\s*\d+)*)',  # Nombre simple
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, texte.lower())
+    texte_lower = texte.lower()
+    for pattern in REGEX_MONTANTS:
+        match = pattern.search(texte_lower)
         if match:
             # Nettoie le montant (supprime espaces)
-            montant_str = re.sub(r'\s+', '', match.group(1))
             try:
-                return int(montant_str)
+                return int(REGEX_ESPACES.sub('', match.group(1)))
             except ValueError:
                 continue
     return None
 
+def personnes_nommees(texte, doc_spacy=None):
+    """Noms de personnes (NER spaCy) d'une phrase ; doc_spacy : analyse déjà faite (traitement par lot)"""
+    with _verrou_cache_personnes:
+        personnes = _cache_personnes.get(texte)
+        if personnes is not None:
+            _cache_personnes.move_to_end(texte)
+            return personnes
+
+    if doc_spacy is None:
+        nlp = modeles.obtenir("spacy")
+        if nlp is None:
+            return ()
+        with metriques.mesurer("spacy"):
+            doc_spacy = nlp(texte)
+    personnes = tuple(ent.text for ent in doc_spacy.ents if ent.label_ == "PER")
+
+    with _verrou_cache_personnes:
+        _cache_personnes[texte] = personnes
+        while len(_cache_personnes) > NLP_CACHE_TAILLE:
+            _cache_personnes.popitem(last=False)
+    return personnes
+
+def besoin_analyse_spacy(texte):
+    """Vrai si extraire_destinataire devra faire appel à spaCy pour cette phrase"""
+    if REGEX_TELEPHONE.search(texte):
+        return False
+    with _verrou_cache_personnes:
+        return texte not in _cache_personnes
+
 def extraire_destinataire(texte, doc_spacy=None):
-    """Extrait le destinataire d'un transfert"""
+    """Extrait le destinataire d'un transfert (spaCy n'est sollicité que sans numéro de téléphone)"""
     # Numéro de téléphone
-    phone_match = re.search(r'(\d{8})', texte)
+    phone_match = REGEX_TELEPHONE.search(texte)
     if phone_match:
         return f"Numéro {phone_match.group(1)}"
     
     # Nom avec spaCy si disponible
-    if doc_spacy:
-        for ent in doc_spacy.ents:
-            if ent.label_ == "PER":
-                return ent.text
+    personnes = personnes_nommees(texte, doc_spacy)
+    if personnes:
+        return personnes[0]
     
     # Recherche de mots après "à"
-    match = re.search(r'\bà\s+([A-Za-zÀ-ÿ\s]+)', texte)
+    match = REGEX_NOM_APRES_A.search(texte)
     if match:
         nom = match.group(1).strip()
         if len(nom) > 1:
@@ -137,44 +1238,459 @@ def extraire_destinataire(texte, doc_spacy=None):
     
     return None
 
+# Serveur Ollama et modèle utilisés pour les demandes non reconnues
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gemma:2b")
+OLLAMA_TIMEOUT = 8
+
+# Session partagée : les connexions keep-alive vers Ollama sont réutilisées d'un appel à l'autre
+session_llm = requests.Session()
+session_llm.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=32))
+
+def requete_llm(prompt, stream):
+    """Corps de la requête /api/generate"""
+    return {
+        "model": OLLAMA_MODEL,
+        "prompt": f"Tu es un assistant Orange Money au Burkina Faso. Réponds en français, de manière simple et amicale.\n\nQuestion: {prompt}\n\nRéponse:",
+        "stream": stream
+    }
+
+# Admission des appels au LLM : appels simultanés, demandes en attente d'une place et durée d'attente (s)
+LLM_CONCURRENCE = int(os.environ.get("LLM_CONCURRENCE", "2"))
+LLM_FILE_MAX = int(os.environ.get("LLM_FILE_MAX", "4"))
+LLM_ATTENTE_MAX = float(os.environ.get("LLM_ATTENTE_MAX", "2"))
+# Disjoncteur : échecs consécutifs avant ouverture, intervalle (s) des sondes de rétablissement
+LLM_ECHECS_MAX = int(os.environ.get("LLM_ECHECS_MAX", "3"))
+LLM_SONDE_INTERVALLE = float(os.environ.get("LLM_SONDE_INTERVALLE", "5"))
+
+# Réponse immédiate quand le LLM n'est pas sollicité (circuit ouvert ou file pleine)
+REPONSE_LLM_INDISPONIBLE = ("Je ne peux pas répondre aux questions libres pour le moment. "
+                            "Je peux toujours consulter votre solde, faire un transfert ou acheter du crédit.")
+
+class LLMIndisponible(Exception):
+    """Appel au LLM refusé sans attendre Ollama"""
+
+class GardeLLM:
+    """Limite les appels simultanés au LLM et coupe le circuit après des échecs répétés"""
+
+    def __init__(self, concurrence, file_max, attente_max, echecs_max, intervalle_sonde):
+        self.concurrence = concurrence
+        # Places libres, et demandes en attente d'une place dans l'ordre d'arrivée (threads et coroutines)
+        self._libres = concurrence
+        self._attentes = deque()
+        self.file_max = file_max
+        self.attente_max = attente_max
+        self.echecs_max = echecs_max
+        self.intervalle_sonde = intervalle_sonde
+        self._verrou = threading.Lock()
+        self._en_cours = 0
+        self._en_attente = 0
+        self._echecs = 0
+        self._ouvert = False
+        self._stats = {"refus_circuit": 0, "refus_file": 0, "ouvertures": 0}
+
+    def _entrer_file(self):
+        """Refuse la demande si le circuit est ouvert ou la file pleine, sinon la compte en attente"""
+        with self._verrou:
+            if self._ouvert:
+                self._stats["refus_circuit"] += 1
+                raise LLMIndisponible("circuit ouvert")
+            if self._en_attente >= self.file_max:
+                self._stats["refus_file"] += 1
+                raise LLMIndisponible("file d'attente pleine")
+            self._en_attente += 1
+
+    def _sortir_file(self, admis):
+        with self._verrou:
+            self._en_attente -= 1
+            if admis:
+                self._en_cours += 1
+            else:
+                self._stats["refus_file"] += 1
+        if not admis:
+            raise LLMIndisponible(f"aucune place libérée en {self.attente_max} s")
+
+    def _ceder(self):
+        """Remet une place à la plus ancienne demande en attente, sinon la libère (appelée sous le verrou)"""
+        while self._attentes:
+            attente = self._attentes.popleft()
+            try:
+                attente["reveiller"]()
+            except RuntimeError:
+                # Boucle asyncio fermée entre-temps : demande abandonnée
+                continue
+            attente["admis"] = True
+            return
+        self._libres += 1
+
+    def _liberer(self):
+        with self._verrou:
+            self._en_cours -= 1
+            self._ceder()
+
+    def _reserver(self, reveiller):
+        """Prend une place libre (None), sinon inscrit la demande dans la file et retourne son attente"""
+        with self._verrou:
+            if self._libres > 0:
+                self._libres -= 1
+                return None
+            attente = {"admis": False, "reveiller": reveiller}
+            self._attentes.append(attente)
+            return attente
+
+    def _renoncer(self, attente):
+        """Fin d'attente : True si une place a été remise entre-temps, sinon retire la demande de la file"""
+        with self._verrou:
+            if attente["admis"]:
+                return True
+            if attente in self._attentes:
+                self._attentes.remove(attente)
+            return False
+
+    def _attendre_place(self):
+        evenement = threading.Event()
+        attente = self._reserver(evenement.set)
+        if attente is None:
+            return True
+        evenement.wait(self.attente_max)
+        return self._renoncer(attente)
+
+    async def _attendre_place_async(self):
+        boucle = asyncio.get_running_loop()
+        future = boucle.create_future()
+
+        def reveiller():
+            boucle.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        attente = self._reserver(reveiller)
+        if attente is None:
+            return True
+        try:
+            await asyncio.wait({future}, timeout=self.attente_max)
+        except asyncio.CancelledError:
+            # Requête annulée : une place reçue entre-temps passe à la demande suivante
+            if self._renoncer(attente):
+                with self._verrou:
+                    self._ceder()
+            raise
+        return self._renoncer(attente)
+
+    @contextmanager
+    def admission(self):
+        """Réserve une place d'appel au LLM ; lève LLMIndisponible si le circuit est ouvert ou la file pleine"""
+        self._entrer_file()
+        admis = False
+        try:
+            with metriques.mesurer("llm_attente"):
+                admis = self._attendre_place()
+        finally:
+            self._sortir_file(admis)
+        try:
+            yield
+        finally:
+            self._liberer()
+
+    @asynccontextmanager
+    async def admission_async(self):
+        """Variante de admission pour le mode ASGI : l'attente d'une place n'occupe aucun thread
+        et partage la file des appels synchrones (ordre d'arrivée)"""
+        self._entrer_file()
+        try:
+            with metriques.mesurer("llm_attente"):
+                admis = await self._attendre_place_async()
+        except BaseException:
+            # Annulation : la demande quitte la file sans être comptée comme un refus
+            with self._verrou:
+                self._en_attente -= 1
+            raise
+        self._sortir_file(admis)
+        try:
+            yield
+        finally:
+            self._liberer()
+
+    def succes(self):
+        with self._verrou:
+            self._echecs = 0
+
+    def echec(self):
+        """Compte un échec (délai dépassé, erreur Ollama) ; ouvre le circuit au-delà de echecs_max"""
+        with self._verrou:
+            self._echecs += 1
+            if self._ouvert or self._echecs < self.echecs_max:
+                return
+            self._ouvert = True
+            self._stats["ouvertures"] += 1
+        logger.warning(f"{OLLAMA_MODEL}: {self.echecs_max} échecs consécutifs, circuit ouvert")
+        threading.Thread(target=self._sonder, name="sonde-llm", daemon=True).start()
+
+    def _sonder(self):
+        """Sonde Ollama en arrière-plan par une génération d'un seul token, sous le délai normal,
+        et ne referme le circuit que lorsque le modèle répond réellement (pas seulement le serveur)"""
+        sonde = {"model": OLLAMA_MODEL, "prompt": "Bonjour", "stream": False, "options": {"num_predict": 1}}
+        while True:
+            time.sleep(self.intervalle_sonde)
+            try:
+                response = session_llm.post(f"{OLLAMA_URL}/api/generate", json=sonde, timeout=OLLAMA_TIMEOUT)
+                if response.status_code == 200 and "response" in response.json():
+                    break
+            except (requests.RequestException, ValueError):
+                pass
+        with self._verrou:
+            self._ouvert = False
+            self._echecs = 0
+        logger.info(f"{OLLAMA_MODEL}: service rétabli, circuit refermé")
+
+    def statistiques(self):
+        """Occupation, état du circuit et compteurs de refus"""
+        with self._verrou:
+            return dict(self._stats, en_cours=self._en_cours, en_attente=self._en_attente,
+                        circuit_ouvert=self._ouvert)
+
+garde_llm = GardeLLM(LLM_CONCURRENCE, LLM_FILE_MAX, LLM_ATTENTE_MAX, LLM_ECHECS_MAX, LLM_SONDE_INTERVALLE)
+
 def obtenir_reponse_llm(prompt):
     """Obtient une réponse du modèle LLaMA local"""
     try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "gemma:2b",
-                "prompt": f"Tu es un assistant Orange Money au Burkina Faso. Réponds en français, de manière simple et amicale.\n\nQuestion: {prompt}\n\nRéponse:",
-                "stream": False
-            },
-            timeout=8
-        )
+        with garde_llm.admission():
+            with metriques.mesurer("llm"):
+                response = session_llm.post(
+                    f"{OLLAMA_URL}/api/generate",
+                    json=requete_llm(prompt, stream=False),
+                    timeout=OLLAMA_TIMEOUT
+                )
         if response.status_code == 200:
+            garde_llm.succes()
+            metriques.incrementer("assistant_llm_total", resultat="succes")
             return response.json().get("response", "Je n'ai pas compris votre demande.")
         else:
+            garde_llm.echec()
+            metriques.incrementer("assistant_llm_total", resultat="erreur")
             return "Service momentanément indisponible."
+    except LLMIndisponible as e:
+        metriques.incrementer("assistant_llm_total", resultat="refus")
+        logger.warning(f"{OLLAMA_MODEL} non sollicité: {e}")
+        return REPONSE_LLM_INDISPONIBLE
     except Exception as e:
-        logger.error(f"Erreur gemma:2b: {e}")
+        garde_llm.echec()
+        metriques.incrementer("assistant_llm_total", resultat="erreur")
+        logger.error(f"Erreur {OLLAMA_MODEL}: {e}")
         return "Je n'ai pas pu traiter votre demande."
 
+def flux_reponse_llm(prompt):
+    """Produit les morceaux de la réponse du LLM au fur et à mesure de leur génération"""
+    with garde_llm.admission():
+        try:
+            yield from _flux_ollama(prompt)
+        except Exception:
+            garde_llm.echec()
+            raise
+        garde_llm.succes()
+
+def _flux_ollama(prompt):
+    """Requête /api/generate en streaming"""
+    debut = time.perf_counter()
+    premier = True
+    with session_llm.post(
+        f"{OLLAMA_URL}/api/generate",
+        json=requete_llm(prompt, stream=True),
+        stream=True,
+        timeout=OLLAMA_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        # Ollama envoie un objet JSON par ligne
+        for ligne in response.iter_lines():
+            if not ligne:
+                continue
+            morceau = json.loads(ligne)
+            if morceau.get("response"):
+                if premier:
+                    metriques.observer_etape("llm_premier_morceau", time.perf_counter() - debut)
+                    premier = False
+                yield morceau["response"]
+            if morceau.get("done"):
+                break
+    metriques.observer_etape("llm_flux", time.perf_counter() - debut)
+
+# ========== CACHE SÉMANTIQUE DES RÉPONSES LLM ==========
+
+# Nombre d'entrées, durée de vie (s), similarité cosinus minimale et fichier de persistance ("" : aucune)
+LLM_CACHE_TAILLE = int(os.environ.get("LLM_CACHE_TAILLE", "500"))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_SEUIL = float(os.environ.get("LLM_CACHE_SEUIL", "0.92"))
+LLM_CACHE_FICHIER = os.environ.get("LLM_CACHE_FICHIER", "llm_cache.json")
+
+# Réponses de repli qui ne doivent jamais être mises en cache
+REPONSES_ERREUR_LLM = {
+    "Je n'ai pas compris votre demande.",
+    "Service momentanément indisponible.",
+    "Je n'ai pas pu traiter votre demande.",
+    REPONSE_LLM_INDISPONIBLE,
+}
+
+def normaliser_question(texte):
+    """Clé exacte : minuscules, sans accents, sans ponctuation"""
+    texte = unicodedata.normalize("NFKD", texte.lower())
+    texte = "".join(c for c in texte if not unicodedata.combining(c))
+    return " ".join(re.findall(r"\w+", texte))
+
+def vecteur_question(texte):
+    """Vecteur normalisé de la question (vecteurs statiques spaCy, sans le pipeline complet)"""
+    # N'attend jamais le chargement de spaCy : clé exacte seulement en attendant
+    nlp = modeles.disponible("spacy")
+    if nlp is None:
+        return None
+    doc = nlp.make_doc(texte)
+    vecteurs = [t.vector for t in doc if t.has_vector and not t.is_stop and not t.is_punct]
+    if not vecteurs:
+        return None
+    vecteur = np.mean(vecteurs, axis=0)
+    norme = np.linalg.norm(vecteur)
+    return vecteur / norme if norme else None
+
+class CacheSemantique:
+    """Cache des réponses LLM : clé exacte d'abord, puis plus proche voisin par similarité"""
+
+    def __init__(self, taille_max, ttl, seuil, fichier=None):
+        self.taille_max = taille_max
+        self.ttl = ttl
+        self.seuil = seuil
+        self.fichier = fichier
+        # clé normalisée -> {"reponse", "date", "texte", "vecteur"} ; ordre LRU
+        # (le vecteur vient du texte en minuscules avec ses accents : les vecteurs spaCy français en dépendent)
+        self._entrees = OrderedDict()
+        self._matrice = None
+        self._cles_matrice = []
+        self._verrou = threading.Lock()
+        self._stats = {"hits_exacts": 0, "hits_semantiques": 0, "misses": 0}
+        if fichier:
+            self._charger()
+
+    def _charger(self):
+        """Recharge les entrées persistées (vecteurs recalculés à la demande)"""
+        try:
+            if os.path.exists(self.fichier):
+                with open(self.fichier, "r", encoding="utf-8") as f:
+                    for cle, entree in json.load(f).items():
+                        self._entrees[cle] = {"reponse": entree["reponse"], "date": entree["date"],
+                                              "texte": entree.get("texte", cle), "vecteur": None}
+                logger.info(f"Cache LLM: {len(self._entrees)} réponses rechargées")
+        except Exception as e:
+            logger.error(f"Erreur chargement cache LLM: {e}")
+
+    def sauvegarder(self):
+        """Persiste les entrées encore valides"""
+        if not self.fichier:
+            return
+        try:
+            with self._verrou:
+                donnees = {cle: {"reponse": e["reponse"], "date": e["date"], "texte": e["texte"]}
+                           for cle, e in self._entrees.items()}
+            chemin_tmp = f"{self.fichier}.{os.getpid()}.tmp"
+            with open(chemin_tmp, "w", encoding="utf-8") as f:
+                json.dump(donnees, f, ensure_ascii=False)
+            os.replace(chemin_tmp, self.fichier)
+        except Exception as e:
+            logger.error(f"Erreur sauvegarde cache LLM: {e}")
+
+    def _purger(self):
+        """Retire les entrées expirées (appelée sous le verrou)"""
+        limite = time.time() - self.ttl
+        expirees = [cle for cle, e in self._entrees.items() if e["date"] < limite]
+        for cle in expirees:
+            del self._entrees[cle]
+        if expirees:
+            self._matrice = None
+
+    def _construire_matrice(self):
+        """Matrice des vecteurs pour la recherche du plus proche voisin (appelée sous le verrou)"""
+        cles, vecteurs = [], []
+        for cle, entree in self._entrees.items():
+            if entree["vecteur"] is None:
+                entree["vecteur"] = vecteur_question(entree["texte"])
+            if entree["vecteur"] is not None:
+                cles.append(cle)
+                vecteurs.append(entree["vecteur"])
+        self._cles_matrice = cles
+        self._matrice = np.vstack(vecteurs) if vecteurs else np.empty((0, 0))
+
+    def chercher(self, texte):
+        """Retourne une réponse en cache pour cette question, ou None"""
+        cle = normaliser_question(texte)
+        with self._verrou:
+            self._purger()
+            entree = self._entrees.get(cle)
+            if entree is not None:
+                self._entrees.move_to_end(cle)
+                self._stats["hits_exacts"] += 1
+                return entree["reponse"]
+
+        vecteur = vecteur_question(texte.lower())
+        with self._verrou:
+            if vecteur is not None and self._entrees:
+                if self._matrice is None:
+                    self._construire_matrice()
+                if len(self._cles_matrice):
+                    similarites = self._matrice @ vecteur
+                    meilleur = int(np.argmax(similarites))
+                    voisin = self._cles_matrice[meilleur]
+                    if similarites[meilleur] >= self.seuil and voisin in self._entrees:
+                        self._entrees.move_to_end(voisin)
+                        self._stats["hits_semantiques"] += 1
+                        return self._entrees[voisin]["reponse"]
+            self._stats["misses"] += 1
+        return None
+
+    def ajouter(self, texte, reponse):
+        """Met en cache la réponse du LLM à une question"""
+        if reponse in REPONSES_ERREUR_LLM:
+            return
+        cle = normaliser_question(texte)
+        texte = texte.lower()
+        vecteur = vecteur_question(texte)
+        with self._verrou:
+            self._entrees.pop(cle, None)
+            self._entrees[cle] = {"reponse": reponse, "date": time.time(), "texte": texte, "vecteur": vecteur}
+            while len(self._entrees) > self.taille_max:
+                self._entrees.popitem(last=False)
+            self._matrice = None
+
+    def statistiques(self):
+        """Taille et compteurs du cache"""
+        with self._verrou:
+            return dict(self._stats, entrees=len(self._entrees))
+
+cache_llm = CacheSemantique(LLM_CACHE_TAILLE, LLM_CACHE_TTL, LLM_CACHE_SEUIL, LLM_CACHE_FICHIER or None)
+atexit.register(cache_llm.sauvegarder)
+
+def repondre_llm(texte):
+    """Réponse à une demande non reconnue, servie par le cache quand c'est possible"""
+    with metriques.mesurer("cache_llm"):
+        reponse = cache_llm.chercher(texte)
+    if reponse is not None:
+        logger.info("reponse llm (cache)")
+        return reponse
+    
+    logger.info("reponse llm")
+    reponse = obtenir_reponse_llm(texte)
+    cache_llm.ajouter(texte, reponse)
+    return reponse
+
 # ========== FONCTIONNALITÉS ORANGE MONEY ==========
 
 def traiter_solde(user_id="default"):
     """Traite une demande de solde"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
-    
-    return (f"Voici vos soldes : "
-            f"Solde principal {user['solde_principal']:,} FCFA, "
-            f"Crédit communication {user['credit_communication']} FCFA, "
-            f"Internet {user['internet_mb']} MB, "
-            f"Bonus fidélité {user['bonus_fidelite']} FCFA.")
-
-def traiter_transfert(texte, user_id="default"):
-    """Traite un transfert d'argent"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
-    
+    with acces_utilisateur(user_id) as user:
+        return (f"Voici vos soldes : "
+                f"Solde principal {user['solde_principal']:,} FCFA, "
+                f"Crédit communication {user['credit_communication']} FCFA, "
+                f"Internet {user['internet_mb']} MB, "
+                f"Bonus fidélité {user['bonus_fidelite']} FCFA.")
+
+def traiter_transfert(texte, user_id="default", doc=None):
+    """Traite un transfert d'argent (doc : analyse spaCy déjà faite, ex. traitement par lot)"""
+    # Extraction hors verrou : spaCy ne bloque pas les autres opérations du compte
     montant = extraire_montant(texte)
-    doc = nlp(texte) if nlp else None
     destinataire = extraire_destinataire(texte, doc)
     
     if not destinataire:
@@ -183,90 +1699,88 @@ def traiter_transfert(texte, user_id="default"):
     if not montant:
         return f"Quel montant voulez-vous envoyer à {destinataire} ?"
     
-    if montant > user["solde_principal"]:
-        return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
-    
-    if montant < 100:
-        return "Le montant minimum est de 100 FCFA."
+    with acces_utilisateur(user_id) as user:
+        if montant > user["solde_principal"]:
+            return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
+        
+        if montant < 100:
+            return "Le montant minimum est de 100 FCFA."
+        
+        if montant > 500000:
+            return "Le montant maximum par transaction est de 500,000 FCFA."
+        
+        # Frais de transfert (simplifié)
+        frais = 0
+        if montant <= 2500:
+            frais = 100
+        elif montant <= 15000:
+            frais = 200
+        else:
+            frais = 500
+        
+        montant_total = montant + frais
+        
+        if montant_total > user["solde_principal"]:
+            return f"Solde insuffisant pour les frais. Total nécessaire: {montant_total:,} FCFA (frais: {frais} FCFA)."
+        
+        # Exécution du transfert
+        user["solde_principal"] -= montant_total
+        
+        # Enregistrement de la transaction
+        transaction = {
+            "id": str(uuid.uuid4())[:8],
+            "type": "transfert",
+            "montant": montant,
+            "frais": frais,
+            "destinataire": destinataire,
+            "date": datetime.now().isoformat(),
+            "statut": "succès"
+        }
+        ajouter_transaction(compte_effectif(user_id), user, transaction)
+        
+        # Sauvegarde
+        enregistrer_operation(user_id, user, transaction)
+        
+        return (f"Transfert effectué ! {montant:,} FCFA envoyés à {destinataire}. "
+                f"Frais: {frais} FCFA. Nouveau solde: {user['solde_principal']:,} FCFA. "
+                f"Référence: {transaction['id']}")
+
+def traiter_recharge_credit(texte, user_id="default"):
+    """Traite une recharge de crédit de communication"""
+    montant = extraire_montant(texte)
     
-    if montant > 500000:
-        return "Le montant maximum par transaction est de 500,000 FCFA."
+    if not montant:
+        return "Quel montant voulez-vous recharger en crédit de communication ?"
     
-    # Frais de transfert (simplifié)
-    frais = 0
-    if montant <= 2500:
-        frais = 100
-    elif montant <= 15000:
-        frais = 200
-    else:
-        frais = 500
-    
-    montant_total = montant + frais
-    
-    if montant_total > user["solde_principal"]:
-        return f"Solde insuffisant pour les frais. Total nécessaire: {montant_total:,} FCFA (frais: {frais} FCFA)."
-    
-    # Exécution du transfert
-    user["solde_principal"] -= montant_total
-    
-    # Enregistrement de la transaction
-    transaction = {
-        "id": str(uuid.uuid4())[:8],
-        "type": "transfert",
-        "montant": montant,
-        "frais": frais,
-        "destinataire": destinataire,
-        "date": datetime.now().isoformat(),
-        "statut": "succès"
-    }
-    user["transactions"].append(transaction)
-    
-    # Sauvegarde
-    save_user_data(user_database)
-    
-    return (f"Transfert effectué ! {montant:,} FCFA envoyés à {destinataire}. "
-            f"Frais: {frais} FCFA. Nouveau solde: {user['solde_principal']:,} FCFA. "
-            f"Référence: {transaction['id']}")
-
-def traiter_recharge_credit(texte, user_id="default"):
-    """Traite une recharge de crédit de communication"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
-    
-    montant = extraire_montant(texte)
-    
-    if not montant:
-        return "Quel montant voulez-vous recharger en crédit de communication ?"
-    
-    if montant > user["solde_principal"]:
-        return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
-    
-    if montant < 500:
-        return "Le montant minimum pour une recharge est de 500 FCFA."
-    
-    # Exécution de la recharge
-    user["solde_principal"] -= montant
-    user["credit_communication"] += montant
-    
-    # Transaction
-    transaction = {
-        "id": str(uuid.uuid4())[:8],
-        "type": "recharge_credit",
-        "montant": montant,
-        "date": datetime.now().isoformat(),
-        "statut": "succès"
-    }
-    user["transactions"].append(transaction)
-    
-    save_user_data(user_database)
-    
-    return (f"Recharge effectuée ! {montant:,} FCFA ajoutés à votre crédit. "
-            f"Nouveau crédit: {user['credit_communication']:,} FCFA. "
-            f"Solde restant: {user['solde_principal']:,} FCFA.")
+    with acces_utilisateur(user_id) as user:
+        if montant > user["solde_principal"]:
+            return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
+        
+        if montant < 500:
+            return "Le montant minimum pour une recharge est de 500 FCFA."
+        
+        # Exécution de la recharge
+        user["solde_principal"] -= montant
+        user["credit_communication"] += montant
+        
+        # Transaction
+        transaction = {
+            "id": str(uuid.uuid4())[:8],
+            "type": "recharge_credit",
+            "montant": montant,
+            "date": datetime.now().isoformat(),
+            "statut": "succès"
+        }
+        ajouter_transaction(compte_effectif(user_id), user, transaction)
+        
+        enregistrer_operation(user_id, user, transaction)
+        
+        return (f"Recharge effectuée ! {montant:,} FCFA ajoutés à votre crédit. "
+                f"Nouveau crédit: {user['credit_communication']:,} FCFA. "
+                f"Solde restant: {user['solde_principal']:,} FCFA.")
 
 def traiter_achat_internet(texte, user_id="default"):
     """Traite un achat de forfait internet"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
-    
     # Forfaits disponibles
     forfaits = {
         "500": {"mb": 100, "prix": 500, "nom": "Forfait 100MB"},
@@ -288,40 +1802,49 @@ def traiter_achat_internet(texte, user_id="default"):
     if not forfait:
         return "Forfait non disponible. Montants disponibles: 500, 1000, 2000, 5000 FCFA."
     
-    if montant > user["solde_principal"]:
-        return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
-    
-    # Achat du forfait
-    user["solde_principal"] -= montant
-    user["internet_mb"] += forfait["mb"]
-    
-    # Transaction
-    transaction = {
-        "id": str(uuid.uuid4())[:8],
-        "type": "achat_internet",
-        "montant": montant,
-        "forfait": forfait["nom"],
-        "date": datetime.now().isoformat(),
-        "statut": "succès"
-    }
-    user["transactions"].append(transaction)
-    
-    save_user_data(user_database)
-    
-    return (f"{forfait['nom']} acheté ! {forfait['mb']} MB ajoutés. "
-            f"Internet total: {user['internet_mb']} MB. "
-            f"Solde restant: {user['solde_principal']:,} FCFA.")
+    with acces_utilisateur(user_id) as user:
+        if montant > user["solde_principal"]:
+            return f"Solde insuffisant. Votre solde est de {user['solde_principal']:,} FCFA."
+        
+        # Achat du forfait
+        user["solde_principal"] -= montant
+        user["internet_mb"] += forfait["mb"]
+        
+        # Transaction
+        transaction = {
+            "id": str(uuid.uuid4())[:8],
+            "type": "achat_internet",
+            "montant": montant,
+            "forfait": forfait["nom"],
+            "date": datetime.now().isoformat(),
+            "statut": "succès"
+        }
+        ajouter_transaction(compte_effectif(user_id), user, transaction)
+        
+        enregistrer_operation(user_id, user, transaction)
+        
+        return (f"{forfait['nom']} acheté ! {forfait['mb']} MB ajoutés. "
+                f"Internet total: {user['internet_mb']} MB. "
+                f"Solde restant: {user['solde_principal']:,} FCFA.")
 
-def traiter_historique(user_id="default"):
+# Filtre de type reconnu dans une demande d'historique vocale
+MOTS_TYPES_HISTORIQUE = {
+    "transfert": "transfert", "envoi": "transfert",
+    "recharge": "recharge_credit", "crédit": "recharge_credit",
+    "internet": "achat_internet", "forfait": "achat_internet",
+    "bonus": "bonus_fidelite",
+}
+
+def traiter_historique(user_id="default", texte=""):
     """Affiche l'historique des transactions"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
+    type_transaction = next((t for mot, t in MOTS_TYPES_HISTORIQUE.items() if mot in texte.lower()), None)
+    # Dernières 5 transactions, sans lecture des archives
+    resultat = consulter_historique(user_id, type_transaction, taille=5, archives=False)
+    dernieres = resultat["transactions"]
     
-    if not user["transactions"]:
+    if not dernieres:
         return "Aucune transaction dans votre historique."
     
-    # Dernières 5 transactions
-    dernieres = user["transactions"][-5:]
-    
     historique = "Vos dernières transactions : "
     for t in dernieres:
         date = datetime.fromisoformat(t["date"]).strftime("%d/%m à %H:%M")
@@ -331,114 +1854,1310 @@ def traiter_historique(user_id="default"):
             historique += f"{date} - Recharge crédit {t['montant']:,} FCFA. "
         elif t["type"] == "achat_internet":
             historique += f"{date} - {t['forfait']} {t['montant']:,} FCFA. "
+        elif t["type"] == "bonus_fidelite":
+            historique += f"{date} - Bonus fidélité {t['montant']:,} FCFA. "
     
+    # Résumé du mois tiré des agrégats, sans parcourir les transactions
+    cumuls = resultat["agregats"].get(periode(datetime.now().isoformat()), {})
+    cumuls = {t: c for t, c in cumuls.items() if type_transaction is None or t == type_transaction}
+    # Dépenses et bonus reçus annoncés séparément : les additionner fausserait le montant
+    depenses = [c for t, c in cumuls.items() if t not in TYPES_CREDITS]
+    credits = [c for t, c in cumuls.items() if t in TYPES_CREDITS]
+    resume = []
+    if depenses or not credits:
+        resume.append(f"{sum(c['nombre'] for c in depenses)} opérations pour "
+                      f"{sum(c['montant'] for c in depenses):,} FCFA")
+    if credits:
+        resume.append(f"{sum(c['nombre'] for c in credits)} bonus reçus pour "
+                      f"{sum(c['montant'] for c in credits):,} FCFA")
+    historique += f"Ce mois-ci : {' et '.join(resume)}."
     return historique
 
 def traiter_bonus_fidelite(user_id="default"):
     """Gère les bonus de fidélité Orange"""
-    user = user_database["users"].get(user_id, user_database["users"]["default"])
-    
-    if user["bonus_fidelite"] <= 0:
-        return "Vous n'avez pas de bonus de fidélité disponible actuellement."
-    
-    # Ajoute le bonus au solde principal
-    bonus = user["bonus_fidelite"]
-    user["solde_principal"] += bonus
-    user["bonus_fidelite"] = 0
-    
-    # Transaction
-    transaction = {
-        "id": str(uuid.uuid4())[:8],
-        "type": "bonus_fidelite",
-        "montant": bonus,
-        "date": datetime.now().isoformat(),
-        "statut": "succès"
-    }
-    user["transactions"].append(transaction)
-    
-    save_user_data(user_database)
-    
-    return f"Bonus de fidélité ajouté ! {bonus:,} FCFA crédités sur votre compte. Nouveau solde: {user['solde_principal']:,} FCFA."
+    with acces_utilisateur(user_id) as user:
+        if user["bonus_fidelite"] <= 0:
+            return "Vous n'avez pas de bonus de fidélité disponible actuellement."
+        
+        # Ajoute le bonus au solde principal
+        bonus = user["bonus_fidelite"]
+        user["solde_principal"] += bonus
+        user["bonus_fidelite"] = 0
+        
+        # Transaction
+        transaction = {
+            "id": str(uuid.uuid4())[:8],
+            "type": "bonus_fidelite",
+            "montant": bonus,
+            "date": datetime.now().isoformat(),
+            "statut": "succès"
+        }
+        ajouter_transaction(compte_effectif(user_id), user, transaction)
+        
+        enregistrer_operation(user_id, user, transaction)
+        
+        return f"Bonus de fidélité ajouté ! {bonus:,} FCFA crédités sur votre compte. Nouveau solde: {user['solde_principal']:,} FCFA."
 
 # ========== ANALYSE NLP PRINCIPALE ==========
 
-def analyser_demande(texte):
-    """Analyse la demande de l'utilisateur et retourne une réponse"""
+# Mots-clés par intention, dans l'ordre de priorité historique (utilisé pour départager les égalités).
+# Poids 2 : mot-clé décisif, poids 1 : mot-clé ambigu ou simple formule de politesse.
+MOTS_CLES_INTENTIONS = [
+    ("salutation", {"bonjour": 1, "salut": 1, "bonsoir": 1, "hello": 1}),
+    ("heure", {"quelle heure": 3, "heure": 2, "temps": 1}),
+    ("solde", {"solde": 2, "mon compte": 2, "combien": 1, "argent": 1}),
+    ("transfert", {"envoie": 2, "transfert": 2, "transfère": 2, "envoi": 2, "donne": 1, "paye": 1}),
+    ("recharge_credit", {"recharge": 2, "crédit": 2, "communication": 2, "appel": 1}),
+    ("internet", {"internet": 2, "data": 2, "forfait": 2, "mb": 1, "gb": 1}),
+    ("historique", {"historique": 2, "transaction": 2, "dernière": 1, "opération": 1}),
+    ("bonus_fidelite", {"bonus": 2, "fidélité": 2, "cadeau": 1, "récompense": 1}),
+    ("services", {"orange": 1, "service": 1, "aide": 1, "assistance": 1}),
+    ("remerciement", {"merci": 1, "thanks": 1}),
+    ("au_revoir", {"au revoir": 1, "bye": 1, "à bientôt": 1}),
+]
+
+Intention = namedtuple("Intention", ["nom", "score", "correspondances"])
+
+REGEX_MOTS = re.compile(r"\w+")
+
+def construire_routeur(mots_cles_intentions):
+    """Indexe tous les mots-clés (un ou deux mots) dans un seul dictionnaire"""
+    index = {}
+    priorites = {}
+    for priorite, (nom, mots_cles) in enumerate(mots_cles_intentions):
+        priorites[nom] = priorite
+        for mot, poids in mots_cles.items():
+            index[" ".join(REGEX_MOTS.findall(mot))] = (nom, poids)
+
+    # Le premier mot d'une expression ne doit pas compter seul (évite le double comptage)
+    premiers_mots = {cle.split()[0] for cle in index if " " in cle}
+    if premiers_mots & index.keys():
+        raise ValueError(f"Mots-clés ambigus : {premiers_mots & index.keys()}")
+    return index, premiers_mots, priorites
+
+INDEX_INTENTIONS, PREMIERS_MOTS_INTENTIONS, PRIORITES_INTENTIONS = construire_routeur(MOTS_CLES_INTENTIONS)
+
+def detecter_intention(texte):
+    """Détecte l'intention en un seul parcours du texte (None si aucune)"""
+    scores = {}
+    correspondances = {}
     texte_lower = texte.lower()
+    precedent = None
+
+    for match in REGEX_MOTS.finditer(texte_lower):
+        cle = match.group()
+        trouve = INDEX_INTENTIONS.get(cle)
+        debut = match.start()
+        # Les expressions de deux mots ("quelle heure") priment sur le mot seul
+        if precedent is not None:
+            expression = INDEX_INTENTIONS.get(f"{precedent.group()} {cle}")
+            if expression is not None:
+                trouve = expression
+                debut = precedent.start()
+        precedent = match if cle in PREMIERS_MOTS_INTENTIONS else None
+
+        if trouve is None:
+            continue
+        nom, poids = trouve
+        scores[nom] = scores.get(nom, 0) + poids
+        correspondances.setdefault(nom, []).append((texte_lower[debut:match.end()], debut, match.end()))
+
+    if not scores:
+        return None
+
+    meilleure = max(scores, key=lambda nom: (scores[nom], -PRIORITES_INTENTIONS[nom]))
+    return Intention(meilleure, scores[meilleure], correspondances[meilleure])
+
+REPONSE_SERVICES = ("Services Orange Money disponibles : "
+                    "Consulter solde, "
+                    "Envoyer argent, "
+                    "Recharger crédit, "
+                    "Acheter internet, "
+                    "Voir historique, "
+                    "Récupérer bonus fidélité.")
+
+# Traitement associé à chaque intention : (texte, user_id) -> réponse
+GESTIONNAIRES_INTENTIONS = {
+    "salutation": lambda texte, user_id: "Bonjour ! Je suis votre assistant Orange Money. Comment puis-je vous aider aujourd'hui ?",
+    "heure": lambda texte, user_id: f"Il est {datetime.now().strftime('%H heures %M minutes')}.",
+    "solde": lambda texte, user_id: traiter_solde(user_id),
+    "transfert": traiter_transfert,
+    "recharge_credit": traiter_recharge_credit,
+    "internet": traiter_achat_internet,
+    "historique": lambda texte, user_id: traiter_historique(user_id, texte),
+    "bonus_fidelite": lambda texte, user_id: traiter_bonus_fidelite(user_id),
+    "services": lambda texte, user_id: REPONSE_SERVICES,
+    "remerciement": lambda texte, user_id: "Avec plaisir ! Y a-t-il autre chose que je puisse faire pour vous ?",
+    "au_revoir": lambda texte, user_id: "Au revoir ! Merci d'avoir utilisé Orange Money. À bientôt !",
+}
+
+def router_demande(texte):
+    """Détecte l'intention d'une demande en comptant les intentions servies"""
+    with metriques.mesurer("intention"):
+        intention = detecter_intention(texte)
+    metriques.incrementer("assistant_intentions_total", intention=intention.nom if intention else "inconnue")
+    trace = trace_requete.get()
+    if trace is not None:
+        trace["intentions"].append(intention.nom if intention else "inconnue")
+    return intention
+
+def analyser_demande(texte, user_id="default"):
+    """Analyse la demande de l'utilisateur et retourne une réponse"""
+    intention = router_demande(texte)
+    if intention is not None:
+        with metriques.mesurer("gestionnaire"):
+            return GESTIONNAIRES_INTENTIONS[intention.nom](texte, user_id)
     
-    # Salutations
-    if re.search(r'\b(bonjour|salut|bonsoir|hello)\b', texte_lower):
-        return "Bonjour ! Je suis votre assistant Orange Money. Comment puis-je vous aider aujourd'hui ?"
-    
-    # Heure
-    if re.search(r'\b(heure|temps|quelle heure)\b', texte_lower):
-        return f"Il est {datetime.now().strftime('%H heures %M minutes')}."
-    
-    # Solde
-    if re.search(r'\b(solde|combien|argent|mon compte)\b', texte_lower):
-        return traiter_solde()
-    
-    # Transfert d'argent
-    if re.search(r'\b(envoie|transfert|transfère|donne|paye|envoi)\b', texte_lower):
-        return traiter_transfert(texte)
-    
-    # Recharge crédit
-    if re.search(r'\b(recharge|crédit|communication|appel)\b', texte_lower):
-        return traiter_recharge_credit(texte)
-    
-    # Internet
-    if re.search(r'\b(internet|data|forfait|mb|gb)\b', texte_lower):
-        return traiter_achat_internet(texte)
-    
-    # Historique
-    if re.search(r'\b(historique|transaction|dernière|opération)\b', texte_lower):
-        return traiter_historique()
-    
-    # Bonus fidélité
-    if re.search(r'\b(bonus|fidélité|cadeau|récompense)\b', texte_lower):
-        return traiter_bonus_fidelite()
-    
-    # Services Orange
-    if re.search(r'\b(orange|service|aide|assistance)\b', texte_lower):
-        return ("Services Orange Money disponibles : "
-                "Consulter solde, "
-                "Envoyer argent, "
-                "Recharger crédit, "
-                "Acheter internet, "
-                "Voir historique, "
-                "Récupérer bonus fidélité.")
-    
-    # Remerciements
-    if re.search(r'\b(merci|thanks)\b', texte_lower):
-        return "Avec plaisir ! Y a-t-il autre chose que je puisse faire pour vous ?"
-    
-    # Au revoir
-    if re.search(r'\b(au revoir|bye|à bientôt)\b', texte_lower):
-        return "Au revoir ! Merci d'avoir utilisé Orange Money. À bientôt !"
-    
-    # Demande non reconnue - utilise
-    logger.info("reponse llm")
-    return obtenir_reponse_llm(texte)
+    # Demande non reconnue - utilise le LLM (via le cache)
+    return repondre_llm(texte)
+
+# ========== STOCKAGE AUDIO ==========
+
+# Quota disque du dossier des réponses (Mo) et durée de vie sans accès (s)
+AUDIO_QUOTA_MO = int(os.environ.get("AUDIO_QUOTA_MO", "500"))
+AUDIO_TTL = int(os.environ.get("AUDIO_TTL", "86400"))
+AUDIO_EVICTION_INTERVAL = int(os.environ.get("AUDIO_EVICTION_INTERVAL", "60"))
+
+# Formats servis : mp3 d'origine et, si ffmpeg est disponible, Opus mono bas débit (conteneur Ogg)
+AUDIO_OPUS = os.environ.get("AUDIO_OPUS", "1") == "1" and AudioSegment.converter is not None
+AUDIO_OPUS_DEBIT = os.environ.get("AUDIO_OPUS_DEBIT", "16k")
+TYPES_AUDIO = {"mp3": "audio/mpeg", "opus": "audio/ogg"}
+FORMATS_AUDIO = ("mp3", "opus") if AUDIO_OPUS else ("mp3",)
+
+REGEX_FICHIER_AUDIO = re.compile(r"response_([0-9a-f-]+)\.(mp3|opus)")
+
+def chemin_audio(audio_id, format_audio="mp3"):
+    """Chemin du fichier audio d'une réponse"""
+    return os.path.join(AUDIO_DIR, f"response_{audio_id}.{format_audio}")
+
+def transcoder_opus(audio_id):
+    """Transcode le mp3 d'une réponse en Opus (voix, mono, AUDIO_OPUS_DEBIT), une seule fois"""
+    chemin = chemin_audio(audio_id, "opus")
+    chemin_tmp = f"{chemin}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        # ffmpeg configuré pour pydub, appelé directement : un seul passage, sans décodage en Python
+        subprocess.run(
+            [AudioSegment.converter, "-nostdin", "-loglevel", "error", "-y", "-i", chemin_audio(audio_id),
+             "-ac", "1", "-c:a", "libopus", "-b:a", AUDIO_OPUS_DEBIT, "-application", "voip",
+             "-f", "ogg", chemin_tmp],
+            check=True, capture_output=True, timeout=30)
+        os.replace(chemin_tmp, chemin)
+    finally:
+        if os.path.exists(chemin_tmp):
+            os.remove(chemin_tmp)
+
+# Mode multi-processus : une synthèse est réservée par un fichier .encours, visible de tous les processus
+AUDIO_RESERVATION_TTL = 300
+
+def reclamer_synthese(audio_id):
+    """Réserve la synthèse d'un audio pour ce processus ; False si un autre processus s'en charge"""
+    if not MULTI_PROCESSUS:
+        return True
+    chemin = chemin_audio(audio_id) + ".encours"
+    try:
+        os.close(os.open(chemin, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        pass
+    # Réservation laissée par un processus arrêté en pleine synthèse
+    try:
+        if time.time() - os.path.getmtime(chemin) < AUDIO_RESERVATION_TTL:
+            return False
+        os.remove(chemin)
+    except FileNotFoundError:
+        pass
+    return reclamer_synthese(audio_id)
+
+def liberer_synthese(audio_id):
+    if MULTI_PROCESSUS:
+        try:
+            os.remove(chemin_audio(audio_id) + ".encours")
+        except FileNotFoundError:
+            pass
+
+def synthese_ailleurs(audio_id):
+    """Vrai si un autre processus synthétise cet audio"""
+    return MULTI_PROCESSUS and os.path.exists(chemin_audio(audio_id) + ".encours")
+
+class StockageAudio:
+    """Index en mémoire des réponses audio, avec quota disque, TTL et éviction LRU"""
+
+    def __init__(self, dossier, quota_octets, ttl):
+        self.dossier = dossier
+        self.quota_octets = quota_octets
+        self.ttl = ttl
+        # audio_id -> (taille, dernier accès, formats présents) ; l'ordre du dict suit les accès (LRU en tête)
+        self._index = OrderedDict()
+        self._octets = 0
+        self._verrou = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "octets_evictes": 0}
+        self._scanner()
+        # Un fork pendant une éviction ne doit pas laisser le verrou pris dans le processus enfant
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._apres_fork)
+
+    def _apres_fork(self):
+        self._verrou = threading.Lock()
+
+    def _scanner(self):
+        """Reconstruit l'index à partir du dossier (au démarrage, et avant chaque éviction en multi-processus)"""
+        fichiers = {}
+        for entree in os.scandir(self.dossier):
+            if not entree.is_file():
+                continue
+            if entree.name.endswith((".part", ".encours")):
+                # Synthèse interrompue par un arrêt du serveur (en multi-processus : seulement si ancienne)
+                if not MULTI_PROCESSUS or time.time() - entree.stat().st_mtime > AUDIO_RESERVATION_TTL:
+                    os.remove(entree.path)
+                continue
+            match = REGEX_FICHIER_AUDIO.fullmatch(entree.name)
+            if match:
+                # Une entrée par réponse : les formats d'un même audio_id sont cumulés
+                stat = entree.stat()
+                taille, acces, formats = fichiers.get(match.group(1), (0, 0, frozenset()))
+                fichiers[match.group(1)] = (taille + stat.st_size, max(acces, stat.st_atime, stat.st_mtime),
+                                            formats | {match.group(2)})
+
+        with self._verrou:
+            anciens = self._index
+            self._index = OrderedDict()
+            self._octets = 0
+            for audio_id, (taille, acces, formats) in sorted(fichiers.items(), key=lambda e: e[1][1]):
+                if audio_id in anciens:
+                    acces = max(acces, anciens[audio_id][1])
+                self._index[audio_id] = (taille, acces, formats)
+                self._octets += taille
+            # Ordre LRU rétabli après la fusion des accès connus de ce processus
+            self._index = OrderedDict(sorted(self._index.items(), key=lambda e: e[1][1]))
+        logger.debug(f"Stockage audio: {len(self._index)} fichiers, {self._octets / 1e6:.1f} Mo")
+
+    def ajouter(self, audio_id):
+        """Indexe un fichier audio qui vient d'être écrit (tous ses formats)"""
+        formats = frozenset(f for f in FORMATS_AUDIO if os.path.exists(chemin_audio(audio_id, f)))
+        taille = sum(os.path.getsize(chemin_audio(audio_id, f)) for f in formats)
+        with self._verrou:
+            ancien = self._index.pop(audio_id, None)
+            if ancien:
+                self._octets -= ancien[0]
+            self._index[audio_id] = (taille, time.time(), formats)
+            self._octets += taille
+            # En multi-processus, l'index local est partiel : seule la boucle d'éviction fait foi
+            depassement = self._octets > self.quota_octets and not MULTI_PROCESSUS
+        if depassement:
+            self.evicter()
+
+    def trouver(self, audio_id, compter=True):
+        """Retourne le chemin d'un audio indexé (None si absent) et met à jour son accès"""
+        with self._verrou:
+            entree = self._index.get(audio_id)
+            if entree is not None:
+                maintenant = time.time()
+                self._index[audio_id] = (entree[0], maintenant, entree[2])
+                self._index.move_to_end(audio_id)
+                if compter:
+                    self._stats["hits"] += 1
+            elif compter:
+                self._stats["misses"] += 1
+
+        if entree is not None:
+            if MULTI_PROCESSUS:
+                # Fichier évincé par un autre processus ; sinon l'accès est reporté sur le fichier
+                # (au plus une fois par minute) pour l'éviction LRU commune
+                try:
+                    if maintenant - entree[1] > 60:
+                        os.utime(chemin_audio(audio_id))
+                    elif not os.path.exists(chemin_audio(audio_id)):
+                        raise FileNotFoundError
+                except FileNotFoundError:
+                    with self._verrou:
+                        if self._index.pop(audio_id, None):
+                            self._octets -= entree[0]
+                    return None
+            return chemin_audio(audio_id)
+
+        # Absent de l'index : le disque n'est consulté que sur un défaut
+        if os.path.exists(chemin_audio(audio_id)):
+            self.ajouter(audio_id)
+            return chemin_audio(audio_id)
+        return None
+
+    def a_format(self, audio_id, format_audio):
+        """Vrai si l'index connaît ce format de l'audio (aucun accès disque)"""
+        with self._verrou:
+            entree = self._index.get(audio_id)
+            return entree is not None and format_audio in entree[2]
+
+    def evicter(self):
+        """Supprime les fichiers expirés puis les moins récemment utilisés au-delà du quota"""
+        limite_acces = time.time() - self.ttl
+        a_supprimer = []
+        with self._verrou:
+            for audio_id, (taille, acces, _) in list(self._index.items()):
+                if acces >= limite_acces and self._octets <= self.quota_octets:
+                    break
+                del self._index[audio_id]
+                self._octets -= taille
+                self._stats["evictions"] += 1
+                self._stats["octets_evictes"] += taille
+                a_supprimer.append(audio_id)
+
+        for audio_id in a_supprimer:
+            for format_audio in TYPES_AUDIO:
+                try:
+                    os.remove(chemin_audio(audio_id, format_audio))
+                except FileNotFoundError:
+                    pass
+        if a_supprimer:
+            logger.info(f"Stockage audio: {len(a_supprimer)} fichiers évincés")
+
+    def boucle_eviction(self, intervalle):
+        """Éviction périodique (thread d'arrière-plan)"""
+        while True:
+            time.sleep(intervalle)
+            try:
+                if MULTI_PROCESSUS:
+                    # Fichiers écrits et lus par les autres processus
+                    self._scanner()
+                self.evicter()
+            except Exception as e:
+                logger.error(f"Erreur éviction audio: {e}")
+
+    def statistiques(self):
+        """Occupation et compteurs du stockage"""
+        with self._verrou:
+            return dict(self._stats, fichiers=len(self._index), octets=self._octets,
+                        quota_octets=self.quota_octets, ttl=self.ttl)
+
+def demarrer_eviction_audio():
+    threading.Thread(target=stockage_audio.boucle_eviction, args=(AUDIO_EVICTION_INTERVAL,),
+                     name="audio-eviction", daemon=True).start()
+
+stockage_audio = StockageAudio(AUDIO_DIR, AUDIO_QUOTA_MO * 1024 * 1024, AUDIO_TTL)
+demarrer_eviction_audio()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=demarrer_eviction_audio)
+
+# ========== SYNTHÈSE VOCALE ==========
+
+# Mode de synthèse : "cache" (réponse complète mise en cache) ou "template" (assemblage de fragments)
+TTS_MODE = os.environ.get("TTS_MODE", "cache")
+FRAGMENTS_DIR = os.path.join(AUDIO_DIR, "fragments")
+# Silence inséré entre deux fragments assemblés (ms)
+TTS_PAUSE_FRAGMENTS_MS = 80
+
+# Parties fixes des réponses, pré-synthétisées en mode template
+FRAGMENTS_FIXES = [
+    "Transfert effectué !", "FCFA envoyés à", "Frais:", "Nouveau solde:", "Référence:",
+    "Recharge effectuée !", "FCFA ajoutés à votre crédit.", "Nouveau crédit:", "Solde restant:",
+    "acheté !", "MB ajoutés.", "Internet total:",
+    "Bonus de fidélité ajouté !", "FCFA crédités sur votre compte.",
+    "Voici vos soldes :", "Solde principal", "Crédit communication", "Internet", "Bonus fidélité",
+    "Solde insuffisant. Votre solde est de", "Quel montant voulez-vous envoyer à",
+    "Vos dernières transactions :", "Transfert", "Recharge crédit",
+    "Il est", "heures", "minutes", "FCFA", "MB", "Numéro",
+]
+
+UNITES_LETTRES = ["zéro", "un", "deux", "trois", "quatre", "cinq", "six", "sept", "huit", "neuf",
+                  "dix", "onze", "douze", "treize", "quatorze", "quinze", "seize",
+                  "dix-sept", "dix-huit", "dix-neuf"]
+DIZAINES_LETTRES = {2: "vingt", 3: "trente", 4: "quarante", 5: "cinquante", 6: "soixante", 8: "quatre-vingt"}
+
+# Numéros de téléphone (8 chiffres), lus deux chiffres par deux chiffres et non comme une quantité
+REGEX_NUMEROS = re.compile(r"\b\d{8}\b")
+# Nombres isolés ("50,000", "1024") mais pas les références alphanumériques ("a1b2c3d4")
+REGEX_NOMBRES = re.compile(r"\b\d{1,3}(?:,\d{3})+\b|\b\d+\b")
+REGEX_SEGMENTS = re.compile(
+    "|".join([REGEX_NUMEROS.pattern, REGEX_NOMBRES.pattern] +
+             [rf"(?<!\w){re.escape(f)}(?!\w)" for f in sorted(FRAGMENTS_FIXES, key=len, reverse=True)])
+)
+
+def _lettres_moins_de_cent(n):
+    """Nombre de 0 à 99 en toutes lettres"""
+    if n < 20:
+        return UNITES_LETTRES[n]
+    dizaine, unite = divmod(n, 10)
+    if dizaine in (7, 9):
+        base = DIZAINES_LETTRES[dizaine - 1]
+        if dizaine == 7 and unite == 1:
+            return "soixante et onze"
+        return f"{base}-{UNITES_LETTRES[10 + unite]}"
+    if unite == 0:
+        return "quatre-vingts" if dizaine == 8 else DIZAINES_LETTRES[dizaine]
+    if unite == 1 and dizaine != 8:
+        return f"{DIZAINES_LETTRES[dizaine]} et un"
+    return f"{DIZAINES_LETTRES[dizaine]}-{UNITES_LETTRES[unite]}"
+
+def _lettres_moins_de_mille(n, final=True):
+    """Nombre de 0 à 999 en toutes lettres (pluriels seulement en fin de nombre)"""
+    centaine, reste = divmod(n, 100)
+    if centaine == 0:
+        lettres = _lettres_moins_de_cent(reste)
+        return lettres if final else lettres.replace("quatre-vingts", "quatre-vingt")
+    prefixe = "cent" if centaine == 1 else f"{UNITES_LETTRES[centaine]} cent"
+    if reste == 0:
+        return prefixe + ("s" if centaine > 1 and final else "")
+    return f"{prefixe} {_lettres_moins_de_cent(reste)}"
+
+# Au-delà (mille milliards), les nombres restent en chiffres et sont lus par la synthèse complète
+NOMBRE_LETTRES_MAX = 10**12 - 1
+
+def nombre_en_lettres(n):
+    """Convertit un entier positif en toutes lettres (français), jusqu'à NOMBRE_LETTRES_MAX"""
+    if not 0 <= n <= NOMBRE_LETTRES_MAX:
+        raise ValueError(f"Nombre hors de la plage écrite en lettres : {n}")
+    if n < 1000:
+        return _lettres_moins_de_mille(n)
+    if n < 1_000_000:
+        milliers, reste = divmod(n, 1000)
+        prefixe = "mille" if milliers == 1 else f"{_lettres_moins_de_mille(milliers, final=False)} mille"
+        return prefixe if reste == 0 else f"{prefixe} {_lettres_moins_de_mille(reste)}"
+    if n < 1_000_000_000:
+        millions, reste = divmod(n, 1_000_000)
+        prefixe = "un million" if millions == 1 else f"{_lettres_moins_de_mille(millions)} millions"
+        return prefixe if reste == 0 else f"{prefixe} {nombre_en_lettres(reste)}"
+    milliards, reste = divmod(n, 1_000_000_000)
+    prefixe = "un milliard" if milliards == 1 else f"{_lettres_moins_de_mille(milliards)} milliards"
+    return prefixe if reste == 0 else f"{prefixe} {nombre_en_lettres(reste)}"
+
+def normaliser_texte_audio(texte):
+    """Normalise un texte avant calcul de la clé de cache"""
+    return " ".join(unicodedata.normalize("NFC", texte).split()).lower()
+
+def identifiant_audio(texte):
+    """Identifiant audio dérivé du contenu : un même texte donne le même fichier"""
+    return hashlib.sha256(normaliser_texte_audio(texte).encode("utf-8")).hexdigest()[:32]
+
+# Moteurs de synthèse essayés dans l'ordre : le suivant prend le relais en cas d'échec ou de dépassement
+# de TTS_TIMEOUT. "gtts" (Google, réseau), "espeak" (espeak-ng local), "piper" (voix neuronale locale)
+TTS_MOTEURS = [m.strip().lower() for m in os.environ.get("TTS_MOTEURS", "gtts").split(",") if m.strip()]
+TTS_TIMEOUT = float(os.environ.get("TTS_TIMEOUT", "10"))
+TTS_ESPEAK_BIN = os.environ.get("TTS_ESPEAK_BIN", "espeak-ng")
+TTS_ESPEAK_VOIX = os.environ.get("TTS_ESPEAK_VOIX", "fr")
+TTS_PIPER_BIN = os.environ.get("TTS_PIPER_BIN", "piper")
+TTS_PIPER_MODELE = os.environ.get("TTS_PIPER_MODELE", "./tools/piper/fr_FR-siwis-medium.onnx")
+# Processus piper gardés chargés (modèle en mémoire) entre deux synthèses
+TTS_PIPER_INSTANCES = int(os.environ.get("TTS_PIPER_INSTANCES", "2"))
+
+metriques.declarer("assistant_tts_total", "counter", "Synthèses par moteur et par résultat (succes, erreur)")
+
+def encoder_mp3(source, cible):
+    """Encode un wav en mp3 mono avec le ffmpeg configuré pour pydub"""
+    subprocess.run(
+        [AudioSegment.converter, "-nostdin", "-loglevel", "error", "-y", "-i", source,
+         "-ac", "1", "-b:a", "48k", "-f", "mp3", cible],
+        check=True, capture_output=True, timeout=TTS_TIMEOUT)
+
+class MoteurGTTS:
+    """Synthèse Google Translate (nécessite le réseau)"""
+
+    nom = "gtts"
+
+    def disponible(self):
+        return True
+
+    def synthetiser(self, texte, chemin):
+        gTTS(texte, lang='fr', slow=False, timeout=TTS_TIMEOUT).save(chemin)
+
+class MoteurEspeak:
+    """Synthèse locale espeak-ng : un processus court par réponse, démarrage quasi instantané"""
+
+    nom = "espeak"
+
+    def __init__(self):
+        self._disponible = which(TTS_ESPEAK_BIN) is not None and AudioSegment.converter is not None
+
+    def disponible(self):
+        return self._disponible
+
+    def synthetiser(self, texte, chemin):
+        chemin_wav = chemin + ".wav"
+        try:
+            subprocess.run([TTS_ESPEAK_BIN, "-v", TTS_ESPEAK_VOIX, "-w", chemin_wav, "--stdin"],
+                           input=texte.encode("utf-8"), check=True, capture_output=True, timeout=TTS_TIMEOUT)
+            encoder_mp3(chemin_wav, chemin)
+        finally:
+            if os.path.exists(chemin_wav):
+                os.remove(chemin_wav)
+
+class MoteurPiper:
+    """Voix neuronale locale piper, servie par un pool de processus gardés chauds (--json-input)"""
+
+    nom = "piper"
+
+    def __init__(self, instances):
+        self.instances = instances
+        self._disponible = (which(TTS_PIPER_BIN) is not None and os.path.exists(TTS_PIPER_MODELE)
+                            and AudioSegment.converter is not None)
+        self._libres = queue.Queue()
+        self._lances = 0
+        self._pid = os.getpid()
+        self._verrou = threading.Lock()
+
+    def disponible(self):
+        return self._disponible
+
+    def _lancer(self):
+        return subprocess.Popen(
+            [TTS_PIPER_BIN, "--model", TTS_PIPER_MODELE, "--json-input"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            text=True, encoding="utf-8", bufsize=1)
+
+    def prechauffer(self):
+        """Lance les processus du pool (chargement du modèle) avant la première synthèse"""
+        while True:
+            with self._verrou:
+                if self._lances >= self.instances:
+                    return
+                self._lances += 1
+            try:
+                self._libres.put(self._lancer())
+            except OSError:
+                with self._verrou:
+                    self._lances -= 1
+                raise
+
+    def _prendre(self):
+        with self._verrou:
+            if self._pid != os.getpid():
+                # Processus forké : les pipes hérités appartiennent au parent
+                self._libres, self._lances, self._pid = queue.Queue(), 0, os.getpid()
+            lancer = self._libres.empty() and self._lances < self.instances
+            if lancer:
+                self._lances += 1
+        if lancer:
+            try:
+                return self._lancer()
+            except OSError:
+                with self._verrou:
+                    self._lances -= 1
+                raise
+        return self._libres.get(timeout=TTS_TIMEOUT)
+
+    def synthetiser(self, texte, chemin):
+        processus = self._prendre()
+        chemin_wav = os.path.abspath(chemin + ".wav")
+        sain = False
+        try:
+            processus.stdin.write(json.dumps({"text": texte, "output_file": chemin_wav}, ensure_ascii=False) + "\n")
+            processus.stdin.flush()
+            # piper écrit le chemin du fichier produit sur sa sortie une fois la synthèse terminée
+            pret, _, _ = select.select([processus.stdout], [], [], TTS_TIMEOUT)
+            if not pret:
+                raise TimeoutError(f"piper: pas de réponse en {TTS_TIMEOUT} s")
+            if not processus.stdout.readline():
+                raise RuntimeError("piper s'est arrêté")
+            encoder_mp3(chemin_wav, chemin)
+            sain = True
+        finally:
+            if os.path.exists(chemin_wav):
+                os.remove(chemin_wav)
+            if sain:
+                self._libres.put(processus)
+            else:
+                # Processus bloqué ou mort : remplacé à la prochaine synthèse
+                processus.kill()
+                with self._verrou:
+                    self._lances -= 1
+
+    def fermer(self):
+        while not self._libres.empty():
+            self._libres.get_nowait().kill()
+
+MOTEURS_TTS = {
+    "gtts": MoteurGTTS,
+    "espeak": MoteurEspeak,
+    "piper": lambda: MoteurPiper(TTS_PIPER_INSTANCES),
+}
+
+for _nom in TTS_MOTEURS:
+    if _nom not in MOTEURS_TTS:
+        logger.warning(f"Moteur de synthèse inconnu dans TTS_MOTEURS : {_nom} (connus : {', '.join(MOTEURS_TTS)})")
+moteurs_tts = [MOTEURS_TTS[nom]() for nom in TTS_MOTEURS if nom in MOTEURS_TTS]
+if not moteurs_tts:
+    raise RuntimeError(f"TTS_MOTEURS={','.join(TTS_MOTEURS)} ne contient aucun moteur connu ({', '.join(MOTEURS_TTS)})")
+for _moteur in moteurs_tts:
+    if not _moteur.disponible():
+        logger.warning(f"Moteur de synthèse {_moteur.nom} indisponible, ignoré")
+    elif hasattr(_moteur, "prechauffer"):
+        threading.Thread(target=_moteur.prechauffer, name=f"tts-{_moteur.nom}", daemon=True).start()
+        atexit.register(_moteur.fermer)
+
+def synthetiser(texte, chemin):
+    """Synthétise un texte en mp3 (écriture atomique) avec le premier moteur de TTS_MOTEURS qui réussit"""
+    erreurs = []
+    for moteur in moteurs_tts:
+        if not moteur.disponible():
+            continue
+        chemin_tmp = f"{chemin}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            moteur.synthetiser(texte, chemin_tmp)
+            os.replace(chemin_tmp, chemin)
+            metriques.incrementer("assistant_tts_total", moteur=moteur.nom, resultat="succes")
+            return
+        except Exception as e:
+            metriques.incrementer("assistant_tts_total", moteur=moteur.nom, resultat="erreur")
+            logger.warning(f"Synthèse {moteur.nom} en échec: {e}")
+            erreurs.append(f"{moteur.nom}: {e}")
+        finally:
+            if os.path.exists(chemin_tmp):
+                os.remove(chemin_tmp)
+    raise RuntimeError(f"Aucun moteur de synthèse n'a abouti ({'; '.join(erreurs) or 'aucun disponible'})")
+
+def decouper_en_fragments(texte):
+    """Découpe une réponse en fragments : parties fixes, mots des nombres, texte libre"""
+    fragments = []
+
+    def ajouter_libre(morceau):
+        morceau = morceau.strip(" .,:;")
+        if morceau:
+            fragments.append(morceau)
+
+    position = 0
+    for match in REGEX_SEGMENTS.finditer(texte):
+        ajouter_libre(texte[position:match.start()])
+        segment = match.group()
+        if REGEX_NUMEROS.fullmatch(segment):
+            for paire in re.findall(r"\d\d", segment):
+                if paire[0] == "0":
+                    fragments.extend(["zéro", UNITES_LETTRES[int(paire[1])]])
+                else:
+                    fragments.extend(re.split(r"[\s-]+", nombre_en_lettres(int(paire))))
+        elif REGEX_NOMBRES.fullmatch(segment) and int(segment.replace(",", "")) <= NOMBRE_LETTRES_MAX:
+            fragments.extend(re.split(r"[\s-]+", nombre_en_lettres(int(segment.replace(",", "")))))
+        else:
+            fragments.append(segment)
+        position = match.end()
+    ajouter_libre(texte[position:])
+    return fragments
+
+def vocabulaire_fragments():
+    """Fragments gardés sur disque et en mémoire : parties fixes et mots des nombres"""
+    vocabulaire = set(FRAGMENTS_FIXES)
+    for n in list(range(100)) + [100, 200, 1000, 1_000_000, 2_000_000, 1_000_000_000, 2_000_000_000]:
+        vocabulaire.update(re.split(r"[\s-]+", nombre_en_lettres(n)))
+    return vocabulaire
+
+VOCABULAIRE_FRAGMENTS = vocabulaire_fragments()
+_segments_fragments = {}
+
+def segment_fragment(fragment):
+    """Retourne le segment audio d'un fragment : vocabulaire synthétisé une seule fois,
+    texte libre (noms, références, réponses du LLM) synthétisé à la volée sans être conservé"""
+    segment = _segments_fragments.get(fragment)
+    if segment is not None:
+        return segment
+    if fragment not in VOCABULAIRE_FRAGMENTS:
+        chemin = os.path.join(FRAGMENTS_DIR, f"libre_{uuid.uuid4().hex}.mp3")
+        try:
+            synthetiser(fragment, chemin)
+            return AudioSegment.from_mp3(chemin)
+        finally:
+            if os.path.exists(chemin):
+                os.remove(chemin)
+    chemin = os.path.join(FRAGMENTS_DIR, f"{identifiant_audio(fragment)}.mp3")
+    if not os.path.exists(chemin):
+        synthetiser(fragment, chemin)
+    segment = AudioSegment.from_mp3(chemin)
+    _segments_fragments[fragment] = segment
+    return segment
+
+def assembler_audio(texte, chemin):
+    """Assemble une réponse à partir des fragments pré-synthétisés"""
+    pause = AudioSegment.silent(duration=TTS_PAUSE_FRAGMENTS_MS)
+    audio = AudioSegment.empty()
+    for fragment in decouper_en_fragments(texte):
+        audio += segment_fragment(fragment) + pause
+
+    chemin_tmp = f"{chemin}.{uuid.uuid4().hex[:8]}.part"
+    audio.export(chemin_tmp, format="mp3")
+    os.replace(chemin_tmp, chemin)
+
+def prechauffer_fragments():
+    """Pré-synthétise les parties fixes et le vocabulaire des nombres"""
+    for fragment in sorted(VOCABULAIRE_FRAGMENTS):
+        try:
+            segment_fragment(fragment)
+        except Exception as e:
+            logger.error(f"Erreur pré-synthèse '{fragment}': {e}")
+            return
+    logger.info(f"{len(VOCABULAIRE_FRAGMENTS)} fragments audio prêts")
 
 def generer_audio(texte):
-    """Génère un fichier audio à partir du texte"""
+    """Génère un fichier audio à partir du texte (réutilise l'audio d'un texte identique)"""
     try:
-        audio_id = str(uuid.uuid4())
-        audio_filename = f"response_{audio_id}.mp3"
-        audio_path = os.path.join(AUDIO_DIR, audio_filename)
+        audio_id = identifiant_audio(texte)
+        audio_path = chemin_audio(audio_id)
+        
+        if stockage_audio.trouver(audio_id, compter=False):
+            logger.info(f"Audio en cache: {audio_path}")
+            return audio_id
         
-        tts = gTTS(texte, lang='fr', slow=False)
-        tts.save(audio_path)
+        if TTS_MODE == "template":
+            try:
+                with metriques.mesurer("tts_assemblage"):
+                    assembler_audio(texte, audio_path)
+            except Exception as e:
+                logger.error(f"Erreur assemblage audio, synthèse complète: {e}")
+                with metriques.mesurer("tts"):
+                    synthetiser(texte, audio_path)
+        else:
+            with metriques.mesurer("tts"):
+                synthetiser(texte, audio_path)
+        if AUDIO_OPUS:
+            # Transcodé dans la foulée : le premier téléchargement n'attend pas ffmpeg
+            try:
+                with metriques.mesurer("transcodage"):
+                    transcoder_opus(audio_id)
+            except Exception as e:
+                logger.error(f"Erreur transcodage Opus: {e}")
+        stockage_audio.ajouter(audio_id)
         
         logger.info(f"Audio généré: {audio_path}")
         return audio_id
         
     except Exception as e:
+        metriques.incrementer("assistant_erreurs_total", etape="tts")
         logger.error(f"Erreur génération audio: {e}")
         return None
 
+if TTS_MODE == "template":
+    os.makedirs(FRAGMENTS_DIR, exist_ok=True)
+    threading.Thread(target=prechauffer_fragments, name="tts-fragments", daemon=True).start()
+
+# Génération audio en arrière-plan : nombre de workers et demandes en attente au maximum
+AUDIO_WORKERS = int(os.environ.get("AUDIO_WORKERS", "4"))
+AUDIO_QUEUE_MAX = int(os.environ.get("AUDIO_QUEUE_MAX", "64"))
+# Attente maximale (s) accordée à GET /audio/<audio_id> pendant la synthèse
+AUDIO_ATTENTE_MAX = float(os.environ.get("AUDIO_ATTENTE_MAX", "15"))
+
+class GenerateurAudio:
+    """Pool borné de synthèse audio : /process rend la main avant la fin de la synthèse"""
+
+    def __init__(self, workers, profondeur_max):
+        self.workers = workers
+        self.profondeur_max = profondeur_max
+        self._initialiser()
+        # Les threads du pool et l'état des synthèses du parent ne survivent pas à un fork
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._initialiser)
+
+    def _initialiser(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tts")
+        self._places = threading.BoundedSemaphore(self.workers + self.profondeur_max)
+        self._en_cours = {}
+        self._verrou = threading.Lock()
+
+    def reserver(self, texte):
+        """Réserve l'audio_id d'un texte et lance sa synthèse ; retourne (audio_id, statut)"""
+        audio_id = identifiant_audio(texte)
+        if stockage_audio.trouver(audio_id, compter=False):
+            return audio_id, "ready"
+
+        with self._verrou:
+            if audio_id in self._en_cours:
+                return audio_id, "pending"
+            if not reclamer_synthese(audio_id):
+                # Synthèse déjà lancée par un autre processus
+                return audio_id, "pending"
+            if self._places.acquire(blocking=False):
+                self._en_cours[audio_id] = self._executor.submit(self._generer, audio_id, texte)
+                return audio_id, "pending"
+
+        # File pleine : la synthèse se fait dans la requête (contre-pression)
+        logger.warning("File de synthèse pleine, génération synchrone")
+        try:
+            audio_id = generer_audio(texte)
+        finally:
+            liberer_synthese(identifiant_audio(texte))
+        return audio_id, "ready" if audio_id else "error"
+
+    def _generer(self, audio_id, texte):
+        """Tâche de synthèse exécutée par un worker"""
+        try:
+            return generer_audio(texte)
+        finally:
+            liberer_synthese(audio_id)
+            with self._verrou:
+                self._en_cours.pop(audio_id, None)
+            self._places.release()
+
+    def en_cours(self):
+        """Nombre de synthèses en cours ou en attente"""
+        with self._verrou:
+            return len(self._en_cours)
+
+    def tache(self, audio_id):
+        """Future de la synthèse en cours dans ce processus (None si aucune)"""
+        return self._en_cours.get(audio_id)
+
+    def attendre(self, audio_id, timeout):
+        """Attend la fin d'une synthèse en cours ; retourne False si elle n'est pas terminée"""
+        future = self._en_cours.get(audio_id)
+        if future is None:
+            # Synthèse éventuellement en cours dans un autre processus
+            limite = time.monotonic() + timeout
+            while synthese_ailleurs(audio_id) and not os.path.exists(chemin_audio(audio_id)):
+                if time.monotonic() >= limite:
+                    return False
+                time.sleep(0.05)
+            return True
+        try:
+            future.result(timeout=timeout)
+            return True
+        except FutureTimeoutError:
+            return False
+
+generateur_audio = GenerateurAudio(AUDIO_WORKERS, AUDIO_QUEUE_MAX)
+
+# ========== RECONNAISSANCE VOCALE ==========
+
+# Nombre maximal de reconnaisseurs Kaldi (donc de reconnaissances simultanées)
+STT_POOL_TAILLE = int(os.environ.get("STT_POOL_TAILLE", "4"))
+# Taux d'échantillonnage par défaut du PCM brut (16 bits, mono)
+STT_TAUX_DEFAUT = 16000
+# Taux d'échantillonnage acceptés (un jeu de reconnaisseurs libres par taux)
+STT_TAUX_ACCEPTES = (8000, 16000, 44100, 48000)
+# Attente maximale (s) d'un reconnaisseur libre avant de répondre 503
+STT_ATTENTE_MAX = float(os.environ.get("STT_ATTENTE_MAX", "5"))
+# Taille des blocs lus dans l'envoi (0,25 s de PCM 16 bits à 16 kHz)
+STT_TAILLE_BLOC = 8000
+
+class PoolReconnaisseurs:
+    """Reconnaisseurs Kaldi réutilisés d'une requête à l'autre, partageant le modèle Vosk"""
+
+    def __init__(self, taille):
+        self._places = threading.BoundedSemaphore(taille)
+        self._libres = {}
+        self._verrou = threading.Lock()
+
+    def emprunter(self, taux, attente):
+        """Emprunte un reconnaisseur pour ce taux d'échantillonnage ; None si aucun ne se libère à temps"""
+        model = modeles.obtenir("vosk")
+        if model is None:
+            raise RuntimeError("Modèle Vosk indisponible")
+
+        if not self._places.acquire(timeout=attente):
+            return None
+        try:
+            with self._verrou:
+                libres = self._libres.setdefault(taux, [])
+                reconnaisseur = libres.pop() if libres else None
+            if reconnaisseur is None:
+                import vosk
+                reconnaisseur = vosk.KaldiRecognizer(model, taux)
+            return reconnaisseur
+        except BaseException:
+            self._places.release()
+            raise
+
+    def rendre(self, taux, reconnaisseur):
+        """Remet un reconnaisseur emprunté dans le pool"""
+        try:
+            reconnaisseur.Reset()
+            with self._verrou:
+                self._libres[taux].append(reconnaisseur)
+        finally:
+            self._places.release()
+
+pool_stt = PoolReconnaisseurs(STT_POOL_TAILLE)
+
+def lire_entete_wav(flux, taux_defaut):
+    """Lit l'en-tête WAV s'il existe ; retourne (taux, octets PCM déjà lus)"""
+    debut = flux.read(12)
+    if len(debut) < 12 or debut[:4] != b"RIFF" or debut[8:12] != b"WAVE":
+        # PCM brut : les octets lus font partie du son
+        return taux_defaut, debut
+
+    taux = None
+    while True:
+        entete = flux.read(8)
+        if len(entete) < 8:
+            raise ValueError("En-tête WAV incomplet")
+        identifiant, taille = entete[:4], int.from_bytes(entete[4:], "little")
+        if identifiant == b"data":
+            break
+        contenu = flux.read(taille + taille % 2)
+        if identifiant == b"fmt ":
+            format_audio = int.from_bytes(contenu[0:2], "little")
+            canaux = int.from_bytes(contenu[2:4], "little")
+            taux = int.from_bytes(contenu[4:8], "little")
+            bits = int.from_bytes(contenu[14:16], "little")
+            if format_audio != 1 or canaux != 1 or bits != 16:
+                raise ValueError("WAV attendu : PCM 16 bits mono")
+
+    if taux is None:
+        raise ValueError("Bloc fmt absent de l'en-tête WAV")
+    return taux, b""
+
+def blocs_audio(flux, deja_lus):
+    """Découpe l'envoi en blocs d'échantillons complets, au fil de la réception"""
+    reste = deja_lus
+    while True:
+        bloc = flux.read(STT_TAILLE_BLOC)
+        if not bloc:
+            break
+        reste += bloc
+        # Un échantillon 16 bits ne doit pas être coupé en deux
+        coupure = len(reste) - len(reste) % 2
+        if coupure:
+            yield reste[:coupure]
+        reste = reste[coupure:]
+
+def reconnaitre(reconnaisseur, blocs):
+    """Alimente le reconnaisseur ; produit des événements partiels puis la transcription finale"""
+    segments = []
+    dernier_partiel = ""
+    for bloc in blocs:
+        if reconnaisseur.AcceptWaveform(bloc):
+            segment = json.loads(reconnaisseur.Result()).get("text", "")
+            if segment:
+                segments.append(segment)
+                yield {"result": segment}
+        else:
+            partiel = json.loads(reconnaisseur.PartialResult()).get("partial", "")
+            if partiel and partiel != dernier_partiel:
+                dernier_partiel = partiel
+                yield {"partial": " ".join(segments + [partiel])}
+
+    segment = json.loads(reconnaisseur.FinalResult()).get("text", "")
+    if segment:
+        segments.append(segment)
+    yield {"final": " ".join(segments).strip()}
+
+# ========== IDEMPOTENCE ==========
+
+# Résultats conservés pour rejouer une demande répétée avec la même clé : nombre, durée de vie (s),
+# attente maximale (s) d'un doublon concurrent, dossier partagé en mode multi-processus
+IDEMPOTENCE_TAILLE = int(os.environ.get("IDEMPOTENCE_TAILLE", "10000"))
+IDEMPOTENCE_TTL = int(os.environ.get("IDEMPOTENCE_TTL", "86400"))
+IDEMPOTENCE_ATTENTE_MAX = float(os.environ.get("IDEMPOTENCE_ATTENTE_MAX", "30"))
+IDEMPOTENCE_DIR = "idempotence"
+IDEMPOTENCE_CLE_MAX = 255
+
+class ConflitIdempotence(Exception):
+    """Clé réutilisée pour une autre demande, ou première exécution toujours en cours"""
+
+    def __init__(self, message, statut):
+        super().__init__(message)
+        self.statut = statut
+
+class RegistreIdempotence:
+    """Résultats des demandes exécutées, par clé d'idempotence (borné, avec TTL)"""
+
+    def __init__(self, taille_max, ttl, attente_max, dossier=None):
+        self.taille_max = taille_max
+        self.ttl = ttl
+        self.attente_max = attente_max
+        # Mode multi-processus : réservations et résultats partagés sur disque
+        self.dossier = dossier
+        # clé -> {"empreinte", "resultat" (None tant que la première exécution n'est pas finie),
+        #         "fin" (Future résolue à la fin de la première exécution), "date"}
+        self._entrees = OrderedDict()
+        self._verrou = threading.Lock()
+        self._derniere_purge = 0.0
+        self._stats = {"executions": 0, "rejeux": 0}
+        if dossier:
+            os.makedirs(dossier, exist_ok=True)
+
+    def _reserver(self, cle, empreinte):
+        """Entrée de la clé et vrai si l'appelant doit exécuter la demande (section courte, sous le verrou)"""
+        with self._verrou:
+            self._purger()
+            entree = self._entrees.get(cle)
+            proprietaire = entree is None
+            if proprietaire:
+                entree = {"empreinte": empreinte, "resultat": None, "fin": Future(), "date": time.time()}
+                self._entrees[cle] = entree
+            elif entree["empreinte"] != empreinte:
+                raise ConflitIdempotence("Clé d'idempotence déjà utilisée pour une autre demande", 422)
+            elif entree["resultat"] is not None:
+                self._stats["rejeux"] += 1
+        return entree, proprietaire
+
+    def _terminer(self, cle, entree, resultat, rejoue):
+        with self._verrou:
+            entree["resultat"] = resultat
+            entree["date"] = time.time()
+            self._stats["rejeux" if rejoue else "executions"] += 1
+            while len(self._entrees) > self.taille_max:
+                self._entrees.popitem(last=False)
+        entree["fin"].set_result(None)
+
+    def _abandonner(self, cle, entree):
+        """Première exécution en échec : la clé est libérée pour la tentative suivante"""
+        with self._verrou:
+            if self._entrees.get(cle) is entree:
+                del self._entrees[cle]
+        entree["fin"].set_result(None)
+
+    def executer(self, cle, empreinte, fonction):
+        """Exécute fonction() une seule fois par clé ; retourne (résultat, rejoué)
+
+        Un doublon concurrent attend la fin de la première exécution ; si celle-ci échoue,
+        la clé est libérée et le doublon l'exécute à son tour.
+        """
+        limite = time.monotonic() + self.attente_max
+        while True:
+            entree, proprietaire = self._reserver(cle, empreinte)
+            if proprietaire:
+                break
+            if entree["resultat"] is not None:
+                return entree["resultat"], True
+            try:
+                entree["fin"].result(timeout=max(0.0, limite - time.monotonic()))
+            except FutureTimeoutError:
+                raise ConflitIdempotence("Demande identique en cours de traitement", 409)
+
+        try:
+            if self.dossier:
+                resultat, rejoue = self._executer_partage(cle, empreinte, fonction, limite)
+            else:
+                resultat, rejoue = fonction(), False
+        except BaseException:
+            self._abandonner(cle, entree)
+            raise
+        self._terminer(cle, entree, resultat, rejoue)
+        return resultat, rejoue
+
+    async def executer_async(self, cle, empreinte, fonction):
+        """Variante de executer pour le mode ASGI : fonction est une coroutine, les attentes ne bloquent
+        aucun thread et seules les sections courtes (verrou, fichiers partagés) passent par un thread"""
+        limite = time.monotonic() + self.attente_max
+        while True:
+            entree, proprietaire = await asyncio.to_thread(self._reserver, cle, empreinte)
+            if proprietaire:
+                break
+            if entree["resultat"] is not None:
+                return entree["resultat"], True
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(entree["fin"])),
+                                       max(0.0, limite - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise ConflitIdempotence("Demande identique en cours de traitement", 409)
+
+        try:
+            if self.dossier:
+                resultat, rejoue = await self._executer_partage_async(cle, empreinte, fonction, limite)
+            else:
+                resultat, rejoue = await fonction(), False
+        except BaseException:
+            await asyncio.to_thread(self._abandonner, cle, entree)
+            raise
+        await asyncio.to_thread(self._terminer, cle, entree, resultat, rejoue)
+        return resultat, rejoue
+
+    def _chemin(self, cle):
+        return os.path.join(self.dossier, hashlib.sha1(cle.encode("utf-8")).hexdigest())
+
+    def _tenter_partage(self, chemin, empreinte):
+        """Une tentative : (résultat stocké par un processus, False) ou (None, réservation obtenue)"""
+        try:
+            with open(chemin + ".json", encoding="utf-8") as f:
+                stocke = json.load(f)
+            if time.time() - stocke["date"] < self.ttl:
+                if stocke["empreinte"] != empreinte:
+                    raise ConflitIdempotence("Clé d'idempotence déjà utilisée pour une autre demande", 422)
+                return stocke["resultat"], False
+        except (FileNotFoundError, ValueError):
+            pass
+        try:
+            os.close(os.open(chemin + ".encours", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return None, True
+        except FileExistsError:
+            pass
+        try:
+            # Réservation laissée par un processus arrêté en pleine exécution
+            if time.time() - os.path.getmtime(chemin + ".encours") > 2 * self.attente_max:
+                os.remove(chemin + ".encours")
+                return self._tenter_partage(chemin, empreinte)
+        except FileNotFoundError:
+            return self._tenter_partage(chemin, empreinte)
+        return None, False
+
+    def _stocker_partage(self, chemin, empreinte, resultat):
+        chemin_tmp = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(chemin_tmp, "w", encoding="utf-8") as f:
+            json.dump({"empreinte": empreinte, "resultat": resultat, "date": time.time()}, f, ensure_ascii=False)
+        os.replace(chemin_tmp, chemin + ".json")
+
+    def _liberer_partage(self, chemin):
+        try:
+            os.remove(chemin + ".encours")
+        except FileNotFoundError:
+            pass
+
+    def _executer_partage(self, cle, empreinte, fonction, limite):
+        """Réservation par fichier .encours et résultat en JSON, visibles de tous les processus"""
+        chemin = self._chemin(cle)
+        while True:
+            stocke, reserve = self._tenter_partage(chemin, empreinte)
+            if stocke is not None:
+                return stocke, True
+            if reserve:
+                break
+            if time.monotonic() >= limite:
+                raise ConflitIdempotence("Demande identique en cours de traitement", 409)
+            time.sleep(0.05)
+
+        try:
+            resultat = fonction()
+            self._stocker_partage(chemin, empreinte, resultat)
+            return resultat, False
+        finally:
+            self._liberer_partage(chemin)
+
+    async def _executer_partage_async(self, cle, empreinte, fonction, limite):
+        chemin = self._chemin(cle)
+        while True:
+            stocke, reserve = await asyncio.to_thread(self._tenter_partage, chemin, empreinte)
+            if stocke is not None:
+                return stocke, True
+            if reserve:
+                break
+            if time.monotonic() >= limite:
+                raise ConflitIdempotence("Demande identique en cours de traitement", 409)
+            await asyncio.sleep(0.05)
+
+        try:
+            resultat = await fonction()
+            await asyncio.to_thread(self._stocker_partage, chemin, empreinte, resultat)
+            return resultat, False
+        finally:
+            await asyncio.to_thread(self._liberer_partage, chemin)
+
+    def _purger(self):
+        """Retire les résultats expirés (appelée sous le verrou, au plus une fois par minute)"""
+        maintenant = time.time()
+        if maintenant - self._derniere_purge < 60:
+            return
+        self._derniere_purge = maintenant
+        for cle in [c for c, e in self._entrees.items() if e["resultat"] is not None and maintenant - e["date"] > self.ttl]:
+            del self._entrees[cle]
+        if self.dossier:
+            for nom in os.listdir(self.dossier):
+                chemin = os.path.join(self.dossier, nom)
+                try:
+                    if nom.endswith(".json") and maintenant - os.path.getmtime(chemin) > self.ttl:
+                        os.remove(chemin)
+                except FileNotFoundError:
+                    pass
+
+    def statistiques(self):
+        with self._verrou:
+            return dict(self._stats, entrees=len(self._entrees))
+
+idempotence = RegistreIdempotence(IDEMPOTENCE_TAILLE, IDEMPOTENCE_TTL, IDEMPOTENCE_ATTENTE_MAX,
+                                  IDEMPOTENCE_DIR if MULTI_PROCESSUS else None)
+
 # ========== ROUTES FLASK ==========
 
+@app.before_request
+def demarrer_chrono():
+    g.debut_requete = time.perf_counter()
+    # Détail des étapes suivi seulement pour /process* et si la capture ou le profilage est actif
+    if not route_profilee(request.path):
+        trace_requete.set(None)
+        return
+    if jeton_profilage_valide(request.headers.get("X-Profile")) or prendre_profilage():
+        route = request.url_rule.rule if request.url_rule else "inconnue"
+        g.echantillonneur = Echantillonneur(threading.get_ident(), PROFIL_INTERVALLE, route)
+    trace_requete.set(nouvelle_trace() if PROFIL_SEUIL > 0 or "echantillonneur" in g else None)
+
+@app.after_request
+def mesurer_requete(response):
+    """Durée et statut par route (pour un flux, jusqu'à l'envoi des en-têtes) ; trace et profil
+    d'un flux terminés seulement après l'envoi complet du corps"""
+    route = request.url_rule.rule if request.url_rule else "inconnue"
+    duree = time.perf_counter() - g.debut_requete if "debut_requete" in g else None
+    if duree is not None:
+        metriques.observer("assistant_requete_duree_secondes", duree, route=route)
+    metriques.incrementer("assistant_requetes_total", route=route, statut=str(response.status_code))
+    
+    trace = trace_requete.get()
+    if trace is not None:
+        echantillonneur = g.pop("echantillonneur", None)
+        profil = echantillonneur.chemin if echantillonneur is not None else None
+        if profil:
+            response.headers["X-Profile-File"] = profil
+        methode, statut, debut = request.method, response.status_code, g.get("debut_requete")
+
+        def terminer():
+            trace_requete.set(None)
+            if echantillonneur is not None:
+                echantillonneur.arreter()
+            if debut is None:
+                return
+            duree_totale = time.perf_counter() - debut
+            if profil or 0 < PROFIL_SEUIL <= duree_totale:
+                consigner_requete_lente(route, methode, statut, duree_totale, trace, profil)
+
+        if response.is_streamed:
+            # /process/stream : le LLM et la synthèse tournent pendant l'envoi du corps, après ce hook
+            response.call_on_close(terminer)
+        else:
+            terminer()
+    return response
+
+@app.route('/admin/profilage', methods=['POST'])
+def activer_profilage():
+    """Profile les N prochaines requêtes /process* (jeton PROFIL_JETON dans l'en-tête X-Profile)"""
+    if not jeton_profilage_valide(request.headers.get("X-Profile")):
+        return jsonify({"error": "Jeton de profilage invalide ou profilage désactivé"}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        nombre = int(data.get("requetes", 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "requetes doit être un entier"}), 400
+    if not 0 <= nombre <= 1000:
+        return jsonify({"error": "requetes doit être compris entre 0 et 1000"}), 400
+    return jsonify({"requetes": demander_profilage(nombre)})
+
+@metriques.collecteur
+def metriques_composants():
+    """Compteurs tenus par les composants, lus au moment de l'exposition"""
+    cache = cache_llm.statistiques()
+    audio = stockage_audio.statistiques()
+    comptes = depot.statistiques()
+    llm = garde_llm.statistiques()
+    idem = idempotence.statistiques()
+    return [
+        ("assistant_cache_llm_total", {"resultat": "hit_exact"}, cache["hits_exacts"]),
+        ("assistant_cache_llm_total", {"resultat": "hit_semantique"}, cache["hits_semantiques"]),
+        ("assistant_cache_llm_total", {"resultat": "miss"}, cache["misses"]),
+        ("assistant_cache_llm_entrees", {}, cache["entrees"]),
+        ("assistant_cache_audio_total", {"resultat": "hit"}, audio["hits"]),
+        ("assistant_cache_audio_total", {"resultat": "miss"}, audio["misses"]),
+        ("assistant_audio_evictions_total", {}, audio["evictions"]),
+        ("assistant_audio_octets", {}, audio["octets"]),
+        ("assistant_tts_en_cours", {}, generateur_audio.en_cours()),
+        ("assistant_shards_en_memoire", {}, comptes["shards_en_memoire"]),
+        ("assistant_llm_en_cours", {}, llm["en_cours"]),
+        ("assistant_llm_en_attente", {}, llm["en_attente"]),
+        ("assistant_llm_circuit_ouvert", {}, int(llm["circuit_ouvert"])),
+        ("assistant_llm_refus_total", {"motif": "circuit"}, llm["refus_circuit"]),
+        ("assistant_llm_refus_total", {"motif": "file"}, llm["refus_file"]),
+        ("assistant_idempotence_total", {"resultat": "execution"}, idem["executions"]),
+        ("assistant_idempotence_total", {"resultat": "rejeu"}, idem["rejeux"]),
+    ]
+
+metriques.declarer("assistant_cache_llm_total", "counter", "Consultations du cache sémantique LLM par résultat")
+metriques.declarer("assistant_cache_llm_entrees", "gauge", "Entrées du cache sémantique LLM")
+metriques.declarer("assistant_cache_audio_total", "counter", "Consultations du stockage audio par résultat")
+metriques.declarer("assistant_audio_evictions_total", "counter", "Fichiers audio évincés")
+metriques.declarer("assistant_audio_octets", "gauge", "Occupation disque des réponses audio")
+metriques.declarer("assistant_tts_en_cours", "gauge", "Synthèses en cours ou en attente")
+metriques.declarer("assistant_shards_en_memoire", "gauge", "Shards de comptes chargés en mémoire")
+metriques.declarer("assistant_idempotence_total", "counter", "Demandes avec clé d'idempotence par résultat (execution, rejeu)")
+metriques.declarer("assistant_llm_en_cours", "gauge", "Appels au LLM en cours")
+metriques.declarer("assistant_llm_en_attente", "gauge", "Demandes en attente d'une place d'appel au LLM")
+metriques.declarer("assistant_llm_circuit_ouvert", "gauge", "1 tant que le disjoncteur du LLM est ouvert")
+metriques.declarer("assistant_llm_refus_total", "counter", "Appels au LLM refusés par motif")
+
+@app.route('/metrics', methods=['GET'])
+def exposer_metriques():
+    """Métriques au format Prometheus"""
+    return Response(metriques.exposer(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/process', methods=['POST'])
 def traiter_texte():
     """Traite une demande en texte"""
@@ -451,65 +3170,476 @@ def traiter_texte():
         if not texte:
             return jsonify({'error': 'Le texte ne peut pas être vide'}), 400
         
-        # Analyse et réponse
-        reponse = analyser_demande(texte)
+        user_id = compte_demande(data.get('user_id'))
+        if user_id is None:
+            return jsonify({'error': 'Compte inconnu'}), 404
+        cle = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if cle is not None and (not isinstance(cle, str) or not 0 < len(cle) <= IDEMPOTENCE_CLE_MAX):
+            return jsonify({'error': f"La clé d'idempotence doit faire de 1 à {IDEMPOTENCE_CLE_MAX} caractères"}), 400
+        
+        def executer():
+            contexte_transaction.reference = None
+            # Analyse et réponse
+            reponse = analyser_demande(texte, user_id)
+            
+            # Génération audio en arrière-plan
+            audio_id, audio_status = generateur_audio.reserver(reponse)
+            
+            return {
+                "text": texte,
+                "response": reponse,
+                "audio_id": audio_id,
+                "audio_status": audio_status,
+                "reference": contexte_transaction.reference,
+                "timestamp": datetime.now().isoformat()
+            }
         
-        # Génération audio
-        audio_id = generer_audio(reponse)
+        if cle is None:
+            return jsonify(executer())
         
-        return jsonify({
-            "text": texte,
-            "response": reponse,
-            "audio_id": audio_id,
-            "timestamp": datetime.now().isoformat()
-        })
+        # Une nouvelle tentative avec la même clé rejoue le résultat sans rien réexécuter
+        empreinte = hashlib.sha1(texte.encode("utf-8")).hexdigest()
+        try:
+            resultat, rejoue = idempotence.executer(f"{user_id}:{cle}", empreinte, executer)
+        except ConflitIdempotence as e:
+            return jsonify({"error": str(e)}), e.statut
+        
+        if rejoue:
+            # Audio adressé par son contenu : aucune synthèse s'il est prêt ou en cours
+            resultat = dict(resultat)
+            resultat["audio_id"], resultat["audio_status"] = generateur_audio.reserver(resultat["response"])
+        response = jsonify(resultat)
+        response.headers["Idempotent-Replayed"] = "true" if rejoue else "false"
+        return response
         
     except Exception as e:
         logger.error(f"Erreur dans /process: {e}")
         return jsonify({"error": "Erreur serveur"}), 500
 
+# Nombre maximal de demandes dans un lot /process/batch
+BATCH_TAILLE_MAX = int(os.environ.get("BATCH_TAILLE_MAX", "100"))
+
+@app.route('/process/batch', methods=['POST'])
+def traiter_lot():
+    """Traite une liste de demandes : spaCy en un seul nlp.pipe, une synthèse par réponse distincte"""
+    try:
+        data = request.get_json(silent=True)
+        demandes = data.get("requests") if isinstance(data, dict) else data
+        if not isinstance(demandes, list) or not demandes:
+            return jsonify({'error': 'Le champ "requests" doit être une liste non vide'}), 400
+        if len(demandes) > BATCH_TAILLE_MAX:
+            return jsonify({'error': f'Au plus {BATCH_TAILLE_MAX} demandes par lot'}), 400
+        
+        # Une demande : {"text": ..., "user_id": ...} ou simplement le texte
+        lot = []
+        for demande in demandes:
+            if isinstance(demande, str):
+                demande = {"text": demande}
+            texte = demande.get("text", "").strip() if isinstance(demande, dict) else ""
+            user_id = compte_demande(demande.get("user_id")) if isinstance(demande, dict) else "default"
+            lot.append((texte, user_id, router_demande(texte) if texte else None))
+        
+        # Analyse spaCy groupée des demandes qui en ont besoin
+        # (transferts sans numéro de téléphone, phrase absente du cache)
+        a_analyser = [i for i, (texte, _, intention) in enumerate(lot)
+                      if intention and intention.nom == "transfert" and besoin_analyse_spacy(texte)]
+        docs = {}
+        nlp = modeles.obtenir("spacy") if a_analyser else None
+        if nlp is not None:
+            # Une phrase répétée dans le lot n'est analysée qu'une fois
+            phrases = list(dict.fromkeys(lot[i][0] for i in a_analyser))
+            with metriques.mesurer("spacy_lot"):
+                analyses = dict(zip(phrases, nlp.pipe(phrases)))
+            docs = {i: analyses[lot[i][0]] for i in a_analyser}
+        
+        # Traitement dans l'ordre du lot (les opérations d'un même compte s'enchaînent)
+        resultats = []
+        for i, (texte, user_id, intention) in enumerate(lot):
+            if not texte:
+                resultats.append({"text": texte, "error": "Le texte ne peut pas être vide"})
+                continue
+            if user_id is None:
+                resultats.append({"text": texte, "error": "Compte inconnu"})
+                continue
+            try:
+                if intention is None:
+                    reponse = repondre_llm(texte)
+                elif i in docs:
+                    with metriques.mesurer("gestionnaire"):
+                        reponse = traiter_transfert(texte, user_id, doc=docs[i])
+                else:
+                    with metriques.mesurer("gestionnaire"):
+                        reponse = GESTIONNAIRES_INTENTIONS[intention.nom](texte, user_id)
+                resultats.append({"text": texte, "response": reponse})
+            except Exception as e:
+                logger.error(f"Erreur dans /process/batch: {e}")
+                resultats.append({"text": texte, "error": "Erreur serveur"})
+        
+        # Une seule synthèse par texte de réponse distinct
+        audios = {}
+        for resultat in resultats:
+            reponse = resultat.get("response")
+            if reponse is None:
+                continue
+            if reponse not in audios:
+                audios[reponse] = generateur_audio.reserver(reponse)
+            resultat["audio_id"], resultat["audio_status"] = audios[reponse]
+        
+        return jsonify({"results": resultats, "timestamp": datetime.now().isoformat()})
+        
+    except Exception as e:
+        logger.error(f"Erreur dans /process/batch: {e}")
+        return jsonify({"error": "Erreur serveur"}), 500
+
+# Fin de phrase dans la réponse en cours de génération (découpage pour la synthèse progressive)
+REGEX_FIN_PHRASE = re.compile(r"[.!?…]+(?:\s+|$)")
+
+def evenement_sse(evenement, donnees):
+    """Formate un événement Server-Sent Events"""
+    return f"event: {evenement}\ndata: {json.dumps(donnees, ensure_ascii=False)}\n\n"
+
+def couper_phrases(tampon):
+    """Sépare les phrases complètes du tampon ; retourne (phrases, reste)"""
+    phrases = []
+    match = REGEX_FIN_PHRASE.search(tampon)
+    while match:
+        phrases.append(tampon[:match.end()].strip())
+        tampon = tampon[match.end():]
+        match = REGEX_FIN_PHRASE.search(tampon)
+    return phrases, tampon
+
+@app.route('/process/stream', methods=['GET', 'POST'])
+def traiter_texte_flux():
+    """Traite une demande en texte et diffuse la réponse en Server-Sent Events"""
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    if not data or 'text' not in data:
+        return jsonify({'error': 'Le champ "text" est requis'}), 400
+    
+    texte = data['text'].strip()
+    if not texte:
+        return jsonify({'error': 'Le texte ne peut pas être vide'}), 400
+    
+    user_id = compte_demande(data.get('user_id'))
+    if user_id is None:
+        return jsonify({'error': 'Compte inconnu'}), 404
+    intention = router_demande(texte)
+    try:
+        if intention is not None:
+            with metriques.mesurer("gestionnaire"):
+                reponse = GESTIONNAIRES_INTENTIONS[intention.nom](texte, user_id)
+        else:
+            with metriques.mesurer("cache_llm"):
+                reponse = cache_llm.chercher(texte)
+    except Exception as e:
+        logger.error(f"Erreur dans /process/stream: {e}")
+        return jsonify({"error": "Erreur serveur"}), 500
+    
+    def generer_evenements():
+        # Demande reconnue ou réponse en cache : réponse complète en un seul événement
+        if reponse is not None:
+            yield evenement_sse("token", {"text": reponse})
+            audio_id, audio_status = generateur_audio.reserver(reponse)
+            yield evenement_sse("audio", {"index": 0, "audio_id": audio_id, "audio_status": audio_status})
+            yield evenement_sse("done", {"text": texte, "response": reponse, "timestamp": datetime.now().isoformat()})
+            return
+        
+        # Demande non reconnue : jetons du LLM relayés au fil de l'eau,
+        # chaque phrase complète part en synthèse sans attendre la fin de la réponse
+        logger.info("reponse llm (flux)")
+        morceaux = []
+        tampon = ""
+        index_audio = 0
+        try:
+            for morceau in flux_reponse_llm(texte):
+                morceaux.append(morceau)
+                yield evenement_sse("token", {"text": morceau})
+                
+                phrases, tampon = couper_phrases(tampon + morceau)
+                for phrase in phrases:
+                    audio_id, audio_status = generateur_audio.reserver(phrase)
+                    yield evenement_sse("audio", {"index": index_audio, "audio_id": audio_id, "audio_status": audio_status})
+                    index_audio += 1
+        except LLMIndisponible as e:
+            metriques.incrementer("assistant_llm_total", resultat="refus")
+            logger.warning(f"{OLLAMA_MODEL} non sollicité: {e}")
+            morceaux.append(REPONSE_LLM_INDISPONIBLE)
+            tampon = REPONSE_LLM_INDISPONIBLE
+            yield evenement_sse("token", {"text": tampon})
+        except Exception as e:
+            metriques.incrementer("assistant_llm_total", resultat="erreur")
+            logger.error(f"Erreur flux {OLLAMA_MODEL}: {e}")
+            if not morceaux:
+                morceaux.append("Je n'ai pas pu traiter votre demande.")
+                tampon = morceaux[0]
+                yield evenement_sse("token", {"text": tampon})
+        else:
+            metriques.incrementer("assistant_llm_total", resultat="succes")
+            if morceaux:
+                cache_llm.ajouter(texte, "".join(morceaux))
+        
+        if tampon.strip():
+            audio_id, audio_status = generateur_audio.reserver(tampon.strip())
+            yield evenement_sse("audio", {"index": index_audio, "audio_id": audio_id, "audio_status": audio_status})
+        
+        yield evenement_sse("done", {"text": texte, "response": "".join(morceaux), "timestamp": datetime.now().isoformat()})
+    
+    return Response(
+        stream_with_context(generer_evenements()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/speech', methods=['POST'])
+def traiter_parole():
+    """Reconnaissance vocale d'un envoi WAV/PCM (éventuellement chunked), réponse en NDJSON"""
+    try:
+        taux_demande = int(request.args.get("rate", STT_TAUX_DEFAUT))
+    except ValueError:
+        return jsonify({"error": "rate doit être un entier (Hz)"}), 400
+    try:
+        taux, deja_lus = lire_entete_wav(request.stream, taux_demande)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if taux not in STT_TAUX_ACCEPTES:
+        return jsonify({"error": f"Taux d'échantillonnage accepté : {', '.join(map(str, STT_TAUX_ACCEPTES))} Hz"}), 400
+    
+    if modeles.obtenir("vosk") is None:
+        return jsonify({"error": "Reconnaissance vocale indisponible"}), 503
+    
+    user_id = compte_demande(request.args.get("user_id"))
+    if user_id is None:
+        return jsonify({"error": "Compte inconnu"}), 404
+    
+    # Reconnaisseur réservé avant la réponse : un pool saturé renvoie 503 au lieu de bloquer un thread
+    reconnaisseur = pool_stt.emprunter(taux, STT_ATTENTE_MAX)
+    if reconnaisseur is None:
+        return jsonify({"error": "Reconnaissance vocale saturée, réessayez"}), 503
+    emprunt = [reconnaisseur]
+    
+    def rendre_reconnaisseur():
+        # Appelée à la fin de la reconnaissance, ou à la fermeture si le flux n'a pas été lu jusque-là
+        if emprunt:
+            pool_stt.rendre(taux, emprunt.pop())
+    
+    def generer_lignes():
+        # La reconnaissance avance pendant la réception : les partiels partent avant la fin de l'envoi
+        transcription = ""
+        try:
+            for evenement in reconnaitre(reconnaisseur, blocs_audio(request.stream, deja_lus)):
+                if "final" in evenement:
+                    transcription = evenement["final"]
+                    break
+                yield json.dumps(evenement, ensure_ascii=False) + "\n"
+        finally:
+            rendre_reconnaisseur()
+        
+        if not transcription:
+            yield json.dumps({"final": True, "text": "", "error": "Aucune parole détectée"}, ensure_ascii=False) + "\n"
+            return
+        
+        reponse = analyser_demande(transcription, user_id)
+        audio_id, audio_status = generateur_audio.reserver(reponse)
+        yield json.dumps({
+            "final": True,
+            "text": transcription,
+            "response": reponse,
+            "audio_id": audio_id,
+            "audio_status": audio_status,
+            "timestamp": datetime.now().isoformat()
+        }, ensure_ascii=False) + "\n"
+    
+    response = Response(stream_with_context(generer_lignes()), mimetype="application/x-ndjson",
+                        headers={"X-Accel-Buffering": "no"})
+    response.call_on_close(rendre_reconnaisseur)
+    return response
+
+# Un audio_id désigne un contenu qui ne change jamais : cache client d'un an
+AUDIO_CACHE_MAX_AGE = 365 * 24 * 3600
+
+def attente_audio(valeur):
+    """Attente demandée par ?wait= en secondes, bornée à [0, AUDIO_ATTENTE_MAX] ; ValueError si invalide"""
+    if valeur is None:
+        return AUDIO_ATTENTE_MAX
+    attente = float(valeur)
+    if math.isnan(attente):
+        raise ValueError(valeur)
+    return min(max(attente, 0), AUDIO_ATTENTE_MAX)
+
+def choisir_format_audio(demande, acceptes):
+    """Format servi : ?format=, sinon négocié sur l'en-tête Accept (mp3 par défaut)"""
+    if demande in FORMATS_AUDIO:
+        return demande
+    if AUDIO_OPUS:
+        meilleur = acceptes.best_match(["audio/mpeg", "audio/ogg", "audio/opus"], "audio/mpeg")
+        if meilleur in ("audio/ogg", "audio/opus"):
+            return "opus"
+    return "mp3"
+
+def entetes_cache_audio(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = AUDIO_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    response.vary.add("Accept")
+    return response
+
+def fichier_audio(audio_id, format_audio):
+    """Chemin du fichier à servir et son format (mp3 si l'Opus manque et ne peut être produit) ; None si absent"""
+    audio_path = stockage_audio.trouver(audio_id)
+    if not audio_path:
+        return None
+    if format_audio == "mp3":
+        return audio_path, "mp3"
+    chemin = chemin_audio(audio_id, format_audio)
+    # Formats connus par l'index : le disque n'est consulté que si l'Opus n'y figure pas
+    if stockage_audio.a_format(audio_id, format_audio):
+        return chemin, format_audio
+    if os.path.exists(chemin):
+        # Écrit par un autre processus
+        stockage_audio.ajouter(audio_id)
+    else:
+        # Audio antérieur au transcodage ou transcodage en échec : rattrapage à la demande
+        try:
+            with metriques.mesurer("transcodage"):
+                transcoder_opus(audio_id)
+            stockage_audio.ajouter(audio_id)
+        except Exception as e:
+            logger.error(f"Erreur transcodage Opus: {e}")
+            return audio_path, "mp3"
+    return chemin, format_audio
+
 @app.route('/audio/<audio_id>', methods=['GET'])
 def obtenir_audio(audio_id):
-    """Récupère un fichier audio"""
+    """Récupère un fichier audio (?wait=<secondes> pour attendre la fin de la synthèse, ?format=mp3|opus)"""
     try:
-        audio_filename = f"response_{audio_id}.mp3"
-        audio_path = os.path.join(AUDIO_DIR, audio_filename)
+        format_audio = choisir_format_audio(request.args.get("format"), request.accept_mimetypes)
+        etag = f"{audio_id}-{format_audio}"
+        # Contenu adressé par son identifiant : une copie déjà détenue par le client est toujours valide
+        # (« * » ne désigne aucune copie précise : il ne doit pas valider un audio qui n'existe pas)
+        if etag in request.if_none_match.as_set(include_weak=True):
+            return entetes_cache_audio(Response(status=304, headers={"ETag": f'"{etag}"'}))
+        
+        try:
+            attente = attente_audio(request.args.get("wait"))
+        except ValueError:
+            return jsonify({"error": "wait doit être un nombre de secondes"}), 400
+        if not generateur_audio.attendre(audio_id, attente):
+            return jsonify({"audio_id": audio_id, "status": "pending"}), 202
         
-        if not os.path.exists(audio_path):
+        fichier = fichier_audio(audio_id, format_audio)
+        if fichier is None:
             return jsonify({"error": "Fichier audio non trouvé"}), 404
+        audio_path, format_audio = fichier
+        etag = f"{audio_id}-{format_audio}"
         
-        return send_file(audio_path, mimetype="audio/mpeg")
+        # ETag, If-None-Match, Range (206) et Last-Modified gérés par send_file
+        return entetes_cache_audio(send_file(
+            os.path.abspath(audio_path),
+            mimetype=TYPES_AUDIO[format_audio],
+            conditional=True,
+            etag=etag,
+            max_age=AUDIO_CACHE_MAX_AGE,
+        ))
         
     except Exception as e:
         logger.error(f"Erreur dans /audio: {e}")
         return jsonify({"error": "Erreur serveur"}), 500
 
+def soldes_utilisateur(user_id):
+    """Soldes d'un compte (réponse de /solde)"""
+    with acces_utilisateur(user_id) as user:
+        return {champ: user[champ] for champ in CHAMPS_SOLDES}
+
 @app.route('/solde', methods=['GET'])
 def obtenir_solde():
     """API pour obtenir le solde directement"""
+    user_id = compte_demande(request.args.get("user_id"))
+    if user_id is None:
+        return jsonify({"error": "Compte inconnu"}), 404
     try:
-        user = user_database["users"]["default"]
-        return jsonify({
-            "solde_principal": user["solde_principal"],
-            "credit_communication": user["credit_communication"],
-            "internet_mb": user["internet_mb"],
-            "bonus_fidelite": user["bonus_fidelite"]
-        })
+        return jsonify(soldes_utilisateur(user_id))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+HISTORIQUE_PAGE_MAX = int(os.environ.get("HISTORIQUE_PAGE_MAX", "100"))
+
+def date_filtre(valeur):
+    """Borne de période de /historique, ramenée au format des dates enregistrées (ISO, heure locale) ;
+    ValueError si ce n'est pas une date ISO"""
+    if not valeur:
+        return None
+    date = datetime.fromisoformat(valeur)
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date.isoformat()
+
+@app.route('/historique', methods=['GET'])
+def obtenir_historique():
+    """Historique paginé : filtres type, debut (inclus) et fin (exclue) en dates ISO"""
+    type_transaction = request.args.get("type") or None
+    if type_transaction is not None and type_transaction not in TYPES_TRANSACTIONS:
+        return jsonify({"error": f"Type inconnu, attendu : {', '.join(TYPES_TRANSACTIONS)}"}), 400
+    try:
+        page = max(1, int(request.args.get("page", "1")))
+        taille = min(HISTORIQUE_PAGE_MAX, max(1, int(request.args.get("taille", "20"))))
+    except ValueError:
+        return jsonify({"error": "page et taille doivent être des entiers"}), 400
+    try:
+        debut = date_filtre(request.args.get("debut"))
+        fin = date_filtre(request.args.get("fin"))
+    except ValueError:
+        return jsonify({"error": "debut et fin doivent être des dates ISO (AAAA-MM-JJ)"}), 400
+    user_id = compte_demande(request.args.get("user_id"))
+    if user_id is None:
+        return jsonify({"error": "Compte inconnu"}), 404
+    try:
+        return jsonify(consulter_historique(
+            user_id,
+            type_transaction,
+            debut=debut,
+            fin=fin,
+            page=page,
+            taille=taille,
+            archives=request.args.get("archives", "1") != "0",
+        ))
+    except Exception as e:
+        logger.error(f"Erreur historique: {e}")
+        return jsonify({"error": "Erreur serveur"}), 500
+
+@app.route('/stats/audio', methods=['GET'])
+def statistiques_audio():
+    """Occupation du stockage audio et compteurs hit/miss/éviction"""
+    return jsonify(stockage_audio.statistiques())
+
 @app.route('/health', methods=['GET'])
 def check_sante():
-    """Vérification de l'état du service"""
-    return jsonify({
+    """Vérification de l'état du service (vivacité + disponibilité de chaque modèle)"""
+    return jsonify(etat_sante())
+
+def etat_sante():
+    """Corps de /health"""
+    etat_modeles = modeles.etat()
+    return {
         "status": "OK",
+        "ready": all(etat_modeles[nom]["etat"] == "ready" for nom in MODELES_PRECHARGES),
         "timestamp": datetime.now().isoformat(),
+        "models": etat_modeles,
         "services": {
-            "vosk": model is not None,
-            "spacy": nlp is not None,
-            "database": os.path.exists("users_data.json")
+            "vosk": etat_modeles["vosk"]["etat"] == "ready",
+            "spacy": etat_modeles["spacy"]["etat"] == "ready",
+            "tts": [moteur.nom for moteur in moteurs_tts if moteur.disponible()],
+            "llm": not garde_llm.statistiques()["circuit_ouvert"],
+            "database": os.path.exists(USERS_META_FILE)
         }
-    })
+    }
+
+@app.route('/health/ready', methods=['GET'])
+def check_disponibilite():
+    """Disponibilité : 503 tant que les modèles préchargés ne sont pas prêts"""
+    etat_modeles = modeles.etat()
+    en_attente = [nom for nom in MODELES_PRECHARGES if etat_modeles[nom]["etat"] != "ready"]
+    if en_attente:
+        return jsonify({"ready": False, "en_attente": en_attente}), 503
+    return jsonify({"ready": True})
 
 @app.route('/demo', methods=['GET'])
 def page_demo():
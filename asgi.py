@@ -0,0 +1,304 @@
+"""
+Mode de service asynchrone (ASGI)
+Expose /process, /audio/<audio_id>, /solde, /health et /metrics sur une boucle asyncio : les appels
+à Ollama passent par un client httpx asynchrone partagé et l'attente d'un audio en cours de synthèse
+n'occupe aucun thread. Le travail bloquant (spaCy, verrous et écriture des comptes, transcodage)
+s'exécute dans un pool de threads borné. Un processus tient ainsi des milliers de demandes lentes
+en parallèle avec quelques dizaines de threads.
+
+Usage : uvicorn asgi:application --host 0.0.0.0 --port 5000
+   ou : gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+import app as backend
+
+logger = logging.getLogger("asgi")
+
+# Threads du pool de travail bloquant et connexions simultanées vers Ollama
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", "16"))
+ASGI_CONNEXIONS_LLM = int(os.environ.get("ASGI_CONNEXIONS_LLM", "64"))
+
+executeur = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi")
+client_llm = None
+
+async def executer(fonction, *args):
+    """Exécute une fonction bloquante dans le pool sans bloquer la boucle (détail de la requête conservé)"""
+    contexte = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executeur, partial(contexte.run, fonction, *args))
+
+# ========== LLM ==========
+
+async def obtenir_reponse_llm(prompt):
+    """Variante asynchrone de backend.obtenir_reponse_llm (même limiteur, même disjoncteur)"""
+    garde = backend.garde_llm
+    try:
+        async with garde.admission_async():
+            with backend.metriques.mesurer("llm"):
+                response = await client_llm.post(
+                    f"{backend.OLLAMA_URL}/api/generate",
+                    json=backend.requete_llm(prompt, stream=False),
+                    timeout=backend.OLLAMA_TIMEOUT
+                )
+        if response.status_code == 200:
+            garde.succes()
+            backend.metriques.incrementer("assistant_llm_total", resultat="succes")
+            return response.json().get("response", "Je n'ai pas compris votre demande.")
+        else:
+            garde.echec()
+            backend.metriques.incrementer("assistant_llm_total", resultat="erreur")
+            return "Service momentanément indisponible."
+    except backend.LLMIndisponible as e:
+        backend.metriques.incrementer("assistant_llm_total", resultat="refus")
+        logger.warning(f"{backend.OLLAMA_MODEL} non sollicité: {e}")
+        return backend.REPONSE_LLM_INDISPONIBLE
+    except Exception as e:
+        garde.echec()
+        backend.metriques.incrementer("assistant_llm_total", resultat="erreur")
+        logger.error(f"Erreur {backend.OLLAMA_MODEL}: {e}")
+        return "Je n'ai pas pu traiter votre demande."
+
+def chercher_cache_llm(texte):
+    with backend.metriques.mesurer("cache_llm"):
+        return backend.cache_llm.chercher(texte)
+
+# ========== TRAITEMENT DES DEMANDES ==========
+
+def executer_gestionnaire(intention, texte, user_id):
+    """Gestionnaire d'intention (spaCy, verrou du compte, persistance) ; retourne (réponse, référence)"""
+    backend.contexte_transaction.reference = None
+    with backend.metriques.mesurer("gestionnaire"):
+        reponse = backend.GESTIONNAIRES_INTENTIONS[intention.nom](texte, user_id)
+    return reponse, backend.contexte_transaction.reference
+
+async def analyser_demande(texte, user_id):
+    """Variante asynchrone de backend.analyser_demande ; retourne (réponse, référence de transaction)"""
+    intention = backend.router_demande(texte)
+    if intention is not None:
+        return await executer(executer_gestionnaire, intention, texte, user_id)
+
+    # Demande non reconnue : cache (vecteurs spaCy) puis LLM sans occuper de thread
+    reponse = await executer(chercher_cache_llm, texte)
+    if reponse is not None:
+        return reponse, None
+    reponse = await obtenir_reponse_llm(texte)
+    await executer(backend.cache_llm.ajouter, texte, reponse)
+    return reponse, None
+
+async def reserver_audio(reponse):
+    # Le plus souvent immédiat ; la synthèse synchrone de contre-pression ne doit pas bloquer la boucle
+    return await executer(backend.generateur_audio.reserver, reponse)
+
+async def traiter_demande(texte, user_id):
+    reponse, reference = await analyser_demande(texte, user_id)
+    audio_id, audio_status = await reserver_audio(reponse)
+    return {
+        "text": texte,
+        "response": reponse,
+        "audio_id": audio_id,
+        "audio_status": audio_status,
+        "reference": reference,
+        "timestamp": datetime.now().isoformat()
+    }
+
+async def traiter_texte(request):
+    """Traite une demande en texte"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or 'text' not in data:
+            return JSONResponse({'error': 'Le champ "text" est requis'}, 400)
+
+        texte = data['text'].strip()
+        if not texte:
+            return JSONResponse({'error': 'Le texte ne peut pas être vide'}, 400)
+
+        user_id = await executer(backend.compte_demande, data.get('user_id'))
+        if user_id is None:
+            return JSONResponse({'error': 'Compte inconnu'}, 404)
+        cle = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if cle is not None and (not isinstance(cle, str) or not 0 < len(cle) <= backend.IDEMPOTENCE_CLE_MAX):
+            return JSONResponse(
+                {'error': f"La clé d'idempotence doit faire de 1 à {backend.IDEMPOTENCE_CLE_MAX} caractères"}, 400)
+
+        if cle is None:
+            return JSONResponse(await traiter_demande(texte, user_id))
+
+        # Attente des doublons et exécution sur la boucle : aucun thread du pool n'attend une coroutine
+        empreinte = hashlib.sha1(texte.encode("utf-8")).hexdigest()
+        try:
+            resultat, rejoue = await backend.idempotence.executer_async(
+                f"{user_id}:{cle}", empreinte, partial(traiter_demande, texte, user_id))
+        except backend.ConflitIdempotence as e:
+            return JSONResponse({"error": str(e)}, e.statut)
+
+        if rejoue:
+            resultat = dict(resultat)
+            resultat["audio_id"], resultat["audio_status"] = await reserver_audio(resultat["response"])
+        return JSONResponse(resultat, headers={"Idempotent-Replayed": "true" if rejoue else "false"})
+
+    except Exception as e:
+        logger.error(f"Erreur dans /process: {e}")
+        return JSONResponse({"error": "Erreur serveur"}, 500)
+
+# ========== AUDIO ==========
+
+async def attendre_audio(audio_id, timeout):
+    """Variante asynchrone de GenerateurAudio.attendre"""
+    future = backend.generateur_audio.tache(audio_id)
+    if future is not None:
+        try:
+            # shield : le délai dépassé ne doit pas annuler la synthèse
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except Exception:
+            return True
+    # Synthèse éventuellement en cours dans un autre processus
+    limite = time.monotonic() + timeout
+    while backend.synthese_ailleurs(audio_id) and not os.path.exists(backend.chemin_audio(audio_id)):
+        if time.monotonic() >= limite:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+def entetes_cache_audio(etag):
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={backend.AUDIO_CACHE_MAX_AGE}, immutable",
+        "Vary": "Accept",
+    }
+
+async def obtenir_audio(request):
+    """Récupère un fichier audio (?wait=<secondes> pour attendre la fin de la synthèse, ?format=mp3|opus)"""
+    audio_id = request.path_params["audio_id"]
+    try:
+        acceptes = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+        format_audio = backend.choisir_format_audio(request.query_params.get("format"), acceptes)
+        etag = f"{audio_id}-{format_audio}"
+        # Contenu adressé par son identifiant : une copie déjà détenue par le client est toujours valide
+        # (« * » ne désigne aucune copie précise : il ne doit pas valider un audio qui n'existe pas)
+        if etag in parse_etags(request.headers.get("if-none-match")).as_set(include_weak=True):
+            return Response(status_code=304, headers=entetes_cache_audio(etag))
+
+        try:
+            attente = backend.attente_audio(request.query_params.get("wait"))
+        except ValueError:
+            return JSONResponse({"error": "wait doit être un nombre de secondes"}, 400)
+        if not await attendre_audio(audio_id, attente):
+            return JSONResponse({"audio_id": audio_id, "status": "pending"}, 202)
+
+        fichier = await executer(backend.fichier_audio, audio_id, format_audio)
+        if fichier is None:
+            return JSONResponse({"error": "Fichier audio non trouvé"}, 404)
+        audio_path, format_audio = fichier
+
+        # Range (206) géré par FileResponse
+        return FileResponse(os.path.abspath(audio_path), media_type=backend.TYPES_AUDIO[format_audio],
+                            headers=entetes_cache_audio(f"{audio_id}-{format_audio}"))
+
+    except Exception as e:
+        logger.error(f"Erreur dans /audio: {e}")
+        return JSONResponse({"error": "Erreur serveur"}, 500)
+
+# ========== COMPTES, ÉTAT, MÉTRIQUES ==========
+
+async def obtenir_solde(request):
+    """API pour obtenir le solde directement"""
+    user_id = await executer(backend.compte_demande, request.query_params.get("user_id"))
+    if user_id is None:
+        return JSONResponse({"error": "Compte inconnu"}, 404)
+    try:
+        return JSONResponse(await executer(backend.soldes_utilisateur, user_id))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 500)
+
+async def check_sante(request):
+    """Vérification de l'état du service (vivacité + disponibilité de chaque modèle)"""
+    return JSONResponse(backend.etat_sante())
+
+async def exposer_metriques(request):
+    """Métriques au format d'exposition Prometheus"""
+    return Response(backend.metriques.exposer(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+class MesureRequetes:
+    """Durée et statut par route et capture des requêtes lentes, comme les hooks Flask de backend
+
+    Le profilage par échantillonnage (X-Profile) n'est pas proposé : la boucle est partagée
+    par toutes les demandes en cours, sa pile ne décrirait pas une requête en particulier.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.application(scope, receive, send)
+        debut = time.perf_counter()
+        trace = backend.nouvelle_trace() if backend.PROFIL_SEUIL > 0 and backend.route_profilee(scope["path"]) else None
+        # Contexte propre à la requête : la trace suit ses étapes jusque dans le pool de threads
+        backend.trace_requete.set(trace)
+
+        async def envoyer(message):
+            if message["type"] == "http.response.start":
+                duree = time.perf_counter() - debut
+                # Même libellé que Flask : /audio/<audio_id>
+                route = scope["route"].path.replace("{", "<").replace("}", ">") if "route" in scope else "inconnue"
+                backend.metriques.observer("assistant_requete_duree_secondes", duree, route=route)
+                backend.metriques.incrementer("assistant_requetes_total", route=route, statut=str(message["status"]))
+                if trace is not None and duree >= backend.PROFIL_SEUIL:
+                    await executer(backend.consigner_requete_lente, route, scope["method"], message["status"],
+                                   duree, trace)
+            await send(message)
+
+        await self.application(scope, receive, envoyer)
+
+@asynccontextmanager
+async def cycle_de_vie(application):
+    """Client HTTP partagé : connexions keep-alive vers Ollama réutilisées par toutes les demandes"""
+    global client_llm
+    client_llm = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASGI_CONNEXIONS_LLM,
+                                                       max_keepalive_connections=ASGI_CONNEXIONS_LLM))
+    logger.info("Démarrage de l'Assistant Orange Money (ASGI)...")
+    try:
+        yield
+    finally:
+        await client_llm.aclose()
+        executeur.shutdown(wait=False)
+
+application = Starlette(
+    routes=[
+        Route("/process", traiter_texte, methods=["POST"]),
+        Route("/audio/{audio_id}", obtenir_audio, methods=["GET"]),
+        Route("/solde", obtenir_solde, methods=["GET"]),
+        Route("/health", check_sante, methods=["GET"]),
+        Route("/metrics", exposer_metriques, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(MesureRequetes),
+    ],
+    lifespan=cycle_de_vie,
+)
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark du routeur d'intentions
+Compare la cascade de re.search historique au routeur compilé en un seul parcours.
+
+Usage : python bench/bench_intentions.py [--repetitions 20000]
+"""
+
+import os
+import re
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import detecter_intention  # noqa: E402
+
+PHRASES = [
+    "Bonjour",
+    "Quelle heure est-il ?",
+    "Quel est mon solde ?",
+    "Envoie 5000 francs à Marie",
+    "Transfère 2500 fcfa au 70112233",
+    "Recharge 2000 francs de crédit",
+    "Achète un forfait internet de 1000 francs",
+    "Montre mon historique",
+    "Récupère mon bonus fidélité",
+    "Quels sont les services Orange ?",
+    "Merci beaucoup",
+    "Au revoir",
+    "Combien coûte un forfait internet de 2000 ?",
+    "Comment retirer de l'argent dans une agence ?",
+    "Je voudrais savoir comment ouvrir un compte marchand",
+]
+
+# Cascade historique de analyser_demande (sans les traitements)
+CASCADE = [
+    ("salutation", r'\b(bonjour|salut|bonsoir|hello)\b'),
+    ("heure", r'\b(heure|temps|quelle heure)\b'),
+    ("solde", r'\b(solde|combien|argent|mon compte)\b'),
+    ("transfert", r'\b(envoie|transfert|transfère|donne|paye|envoi)\b'),
+    ("recharge_credit", r'\b(recharge|crédit|communication|appel)\b'),
+    ("internet", r'\b(internet|data|forfait|mb|gb)\b'),
+    ("historique", r'\b(historique|transaction|dernière|opération)\b'),
+    ("bonus_fidelite", r'\b(bonus|fidélité|cadeau|récompense)\b'),
+    ("services", r'\b(orange|service|aide|assistance)\b'),
+    ("remerciement", r'\b(merci|thanks)\b'),
+    ("au_revoir", r'\b(au revoir|bye|à bientôt)\b'),
+]
+
+def intention_cascade(texte):
+    """Intention retenue par la cascade historique"""
+    texte_lower = texte.lower()
+    for nom, motif in CASCADE:
+        if re.search(motif, texte_lower):
+            return nom
+    return None
+
+def intention_routeur(texte):
+    """Intention retenue par le routeur compilé"""
+    intention = detecter_intention(texte)
+    return intention.nom if intention else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repetitions", type=int, default=20000)
+    args = parser.parse_args()
+
+    for nom, fonction in (("cascade", intention_cascade), ("routeur", intention_routeur)):
+        duree = timeit.timeit(lambda: [fonction(p) for p in PHRASES], number=args.repetitions)
+        par_phrase = duree / (args.repetitions * len(PHRASES)) * 1e6
+        print(f"{nom:8} {par_phrase:8.2f} µs/phrase")
+
+    print("\nDivergences (cascade -> routeur) :")
+    for phrase in PHRASES:
+        avant, apres = intention_cascade(phrase), intention_routeur(phrase)
+        if avant != apres:
+            print(f"  {phrase!r}: {avant} -> {apres}")
+
+if __name__ == "__main__":
+    main()
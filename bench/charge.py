@@ -0,0 +1,296 @@
+"""
+Test de charge reproductible du backend
+Démarre l'application dans un processus séparé (bench/serveur_charge.py) et un dossier
+temporaire, avec le stub Ollama et une synthèse vocale factice aux latences réglables, puis
+envoie le corpus (bench/corpus_fr.json) à plusieurs niveaux de concurrence. Rapporte débit et
+p50/p95/p99 par endpoint et par intention, et enregistre les résultats en JSON pour comparer
+deux commits.
+
+Usage : python bench/charge.py --concurrence 1,4,16 --requetes 400 --endpoints process,stream
+        python bench/charge.py --url http://localhost:5000   (serveur déjà lancé, sans stubs)
+        python bench/charge.py --comparer bench/resultats/avant.json bench/resultats/apres.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import atexit
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import requests
+
+DOSSIER_BENCH = os.path.dirname(os.path.abspath(__file__))
+RACINE = os.path.dirname(DOSSIER_BENCH)
+
+ENDPOINTS = ("process", "stream", "batch", "solde", "historique")
+TAILLE_LOT = 10
+
+def charger_corpus(chemin):
+    """Liste de (intention, phrase) du corpus"""
+    with open(chemin, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    return [(intention, phrase) for intention, phrases in corpus.items() for phrase in phrases]
+
+def version_code():
+    """Commit courant (suffixe -modifie si l'arbre de travail a des changements)"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RACINE,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        modifie = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=RACINE,
+                                 capture_output=True, text=True).stdout.strip()
+        return commit + ("-modifie" if modifie else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "inconnu"
+
+def port_libre():
+    """Port TCP local libre, attribué par le système"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def attendre_serveur(url, processus, delai=120):
+    """Attend que le serveur réponde (chargement des modèles compris)"""
+    limite = time.monotonic() + delai
+    while time.monotonic() < limite:
+        if processus.poll() is not None:
+            raise RuntimeError(f"{url} : le processus s'est arrêté (code {processus.returncode})")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} : pas de réponse en {delai} s")
+
+def demarrer_application(args):
+    """Lance le stub Ollama et le backend (bench/serveur_charge.py) dans leurs propres processus ;
+    retourne l'URL de base. Les processus sont arrêtés à la sortie du benchmark."""
+    port_ollama, port_backend = port_libre(), port_libre()
+    stub = subprocess.Popen([sys.executable, os.path.join(DOSSIER_BENCH, "stub_ollama.py"),
+                             "--port", str(port_ollama),
+                             "--latence-premier", str(args.latence_llm_premier),
+                             "--latence-token", str(args.latence_llm_token)],
+                            stdout=subprocess.DEVNULL)
+    atexit.register(stub.terminate)
+    attendre_serveur(f"http://127.0.0.1:{port_ollama}/api/tags", stub)
+
+    env = dict(os.environ, OLLAMA_URL=f"http://127.0.0.1:{port_ollama}", LLM_CACHE_FICHIER="")
+    env.setdefault("TTS_MODE", "cache")
+    if args.sans_cache_llm:
+        env["LLM_CACHE_TAILLE"] = "0"
+    # Comptes, journal et audio dans un dossier jetable : chaque exécution part du même état
+    backend = subprocess.Popen([sys.executable, os.path.join(DOSSIER_BENCH, "serveur_charge.py"),
+                                "--port", str(port_backend), "--comptes", str(args.comptes),
+                                "--latence-tts", str(args.latence_tts)],
+                               cwd=tempfile.mkdtemp(prefix="charge-"), env=env)
+    atexit.register(backend.terminate)
+    url = f"http://127.0.0.1:{port_backend}"
+    attendre_serveur(f"{url}/health", backend)
+    return url
+
+def preparer_requetes(corpus, endpoints, nombre, comptes, graine):
+    """Suite déterministe de (endpoint, intention, phrase(s), user_id)"""
+    aleatoire = random.Random(graine)
+    requetes = []
+    for i in range(nombre):
+        endpoint = endpoints[i % len(endpoints)]
+        user_id = f"charge{aleatoire.randrange(comptes)}" if comptes else "default"
+        if endpoint == "batch":
+            lot = [aleatoire.choice(corpus)[1] for _ in range(TAILLE_LOT)]
+            requetes.append((endpoint, "lot", lot, user_id))
+        elif endpoint in ("solde", "historique"):
+            requetes.append((endpoint, endpoint, None, user_id))
+        else:
+            intention, phrase = aleatoire.choice(corpus)
+            requetes.append((endpoint, intention, phrase, user_id))
+    return requetes
+
+def executer(session, url, endpoint, texte, user_id, audio):
+    """Envoie une requête et lit la réponse complète ; retourne True si elle a réussi"""
+    if endpoint == "process":
+        reponse = session.post(f"{url}/process", json={"text": texte, "user_id": user_id})
+        if audio and reponse.ok and reponse.json().get("audio_id"):
+            return session.get(f"{url}/audio/{reponse.json()['audio_id']}").ok
+    elif endpoint == "stream":
+        reponse = session.post(f"{url}/process/stream", json={"text": texte, "user_id": user_id}, stream=True)
+        for _ in reponse.iter_content(chunk_size=None):
+            pass
+    elif endpoint == "batch":
+        lot = [{"text": phrase, "user_id": user_id} for phrase in texte]
+        reponse = session.post(f"{url}/process/batch", json={"requests": lot})
+    elif endpoint == "solde":
+        reponse = session.get(f"{url}/solde", params={"user_id": user_id})
+    else:
+        reponse = session.get(f"{url}/historique", params={"user_id": user_id, "taille": 20})
+    return reponse.ok
+
+def centile(valeurs_triees, p):
+    """Centile par rang le plus proche"""
+    if not valeurs_triees:
+        return None
+    rang = max(1, math.ceil(p / 100 * len(valeurs_triees)))
+    return valeurs_triees[rang - 1]
+
+def resumer(mesures, duree):
+    """Statistiques d'une série de (latence en s, succès)"""
+    latences = sorted(latence * 1000 for latence, _ in mesures)
+    return {
+        "requetes": len(mesures),
+        "erreurs": sum(1 for _, ok in mesures if not ok),
+        "debit_rps": round(len(mesures) / duree, 2) if duree else None,
+        "moyenne_ms": round(sum(latences) / len(latences), 2) if latences else None,
+        "p50_ms": round(centile(latences, 50), 2) if latences else None,
+        "p95_ms": round(centile(latences, 95), 2) if latences else None,
+        "p99_ms": round(centile(latences, 99), 2) if latences else None,
+        "max_ms": round(latences[-1], 2) if latences else None,
+    }
+
+def mesurer_niveau(url, requetes, concurrence, audio):
+    """Exécute les requêtes avec `concurrence` clients ; retourne les statistiques du niveau"""
+    file_requetes = iter(requetes)
+    verrou = threading.Lock()
+    resultats = []
+
+    def client():
+        session = requests.Session()
+        while True:
+            with verrou:
+                requete = next(file_requetes, None)
+            if requete is None:
+                return
+            endpoint, intention, texte, user_id = requete
+            debut = time.perf_counter()
+            try:
+                ok = executer(session, url, endpoint, texte, user_id, audio)
+            except requests.RequestException:
+                ok = False
+            latence = time.perf_counter() - debut
+            with verrou:
+                resultats.append((endpoint, intention, latence, ok))
+
+    debut = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrence)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duree = time.perf_counter() - debut
+
+    par_endpoint, par_intention = {}, {}
+    for endpoint, intention, latence, ok in resultats:
+        par_endpoint.setdefault(endpoint, []).append((latence, ok))
+        par_intention.setdefault(intention, []).append((latence, ok))
+    return {
+        "concurrence": concurrence,
+        "duree_s": round(duree, 3),
+        "global": resumer([(latence, ok) for _, _, latence, ok in resultats], duree),
+        "endpoints": {nom: resumer(mesures, duree) for nom, mesures in sorted(par_endpoint.items())},
+        "intentions": {nom: resumer(mesures, duree) for nom, mesures in sorted(par_intention.items())},
+    }
+
+def afficher_niveau(niveau):
+    print(f"\nConcurrence {niveau['concurrence']} : {niveau['global']['debit_rps']} req/s "
+          f"en {niveau['duree_s']} s, {niveau['global']['erreurs']} erreurs")
+    print(f"  {'':20} {'req':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for groupe in ("endpoints", "intentions"):
+        for nom, stats in niveau[groupe].items():
+            print(f"  {nom:20} {stats['requetes']:6} {stats['erreurs']:5} "
+                  f"{stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f}")
+        print()
+
+def comparer(chemin_avant, chemin_apres, seuil):
+    """Affiche l'évolution par niveau et endpoint ; retourne le nombre de régressions"""
+    with open(chemin_avant, "r", encoding="utf-8") as f:
+        avant = json.load(f)
+    with open(chemin_apres, "r", encoding="utf-8") as f:
+        apres = json.load(f)
+    print(f"{avant['commit']} -> {apres['commit']} (régression au-delà de {seuil} %)")
+
+    def ecart(ancien, nouveau):
+        return (nouveau - ancien) / ancien * 100 if ancien else 0.0
+
+    regressions = 0
+    niveaux_avant = {n["concurrence"]: n for n in avant["niveaux"]}
+    for niveau in apres["niveaux"]:
+        ancien_niveau = niveaux_avant.get(niveau["concurrence"])
+        if ancien_niveau is None:
+            continue
+        print(f"\nConcurrence {niveau['concurrence']}")
+        for nom, stats in niveau["endpoints"].items():
+            ancien = ancien_niveau["endpoints"].get(nom)
+            if ancien is None:
+                continue
+            ecarts = {cle: ecart(ancien[cle], stats[cle]) for cle in ("p50_ms", "p95_ms", "p99_ms", "debit_rps")}
+            regression = ecarts["p95_ms"] > seuil or ecarts["debit_rps"] < -seuil
+            regressions += regression
+            print(f"  {nom:12} " + "  ".join(f"{cle} {ancien[cle]} -> {stats[cle]} ({ecarts[cle]:+.1f} %)"
+                                              for cle in ecarts) + ("  REGRESSION" if regression else ""))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrence", default="1,4,16", help="niveaux de concurrence, séparés par des virgules")
+    parser.add_argument("--requetes", type=int, default=300, help="requêtes par niveau")
+    parser.add_argument("--echauffement", type=int, default=20, help="requêtes non mesurées avant le premier niveau")
+    parser.add_argument("--endpoints", default="process", help=f"parmi {','.join(ENDPOINTS)}")
+    parser.add_argument("--audio", action="store_true", help="récupérer aussi l'audio de chaque /process")
+    parser.add_argument("--corpus", default=os.path.join(DOSSIER_BENCH, "corpus_fr.json"))
+    parser.add_argument("--comptes", type=int, default=20, help="comptes de test répartis entre les requêtes")
+    parser.add_argument("--graine", type=int, default=42)
+    parser.add_argument("--latence-llm-premier", type=float, default=0.2, help="stub Ollama : délai du premier jeton (s)")
+    parser.add_argument("--latence-llm-token", type=float, default=0.01, help="stub Ollama : délai entre jetons (s)")
+    parser.add_argument("--latence-tts", type=float, default=0.3, help="synthèse factice : durée par réponse (s)")
+    parser.add_argument("--sans-cache-llm", action="store_true", help="désactive le cache sémantique des réponses LLM")
+    parser.add_argument("--url", help="serveur déjà démarré (aucun stub, compte default)")
+    parser.add_argument("--sortie", help="fichier JSON des résultats (défaut : bench/resultats/charge-<commit>-<date>.json)")
+    parser.add_argument("--comparer", nargs=2, metavar=("AVANT", "APRES"), help="compare deux fichiers de résultats")
+    parser.add_argument("--seuil", type=float, default=10.0, help="régression tolérée en %% (p95 et débit)")
+    args = parser.parse_args()
+
+    if args.comparer:
+        sys.exit(1 if comparer(*args.comparer, args.seuil) else 0)
+
+    endpoints = args.endpoints.split(",")
+    inconnus = set(endpoints) - set(ENDPOINTS)
+    if inconnus:
+        parser.error(f"endpoints inconnus : {', '.join(sorted(inconnus))}")
+    niveaux = [int(n) for n in args.concurrence.split(",")]
+    corpus = charger_corpus(args.corpus)
+    commit = version_code()
+    sortie = os.path.abspath(args.sortie or os.path.join(
+        DOSSIER_BENCH, "resultats", f"charge-{commit}-{datetime.now():%Y%m%d-%H%M%S}.json"))
+
+    if args.url:
+        url, comptes = args.url.rstrip("/"), 0
+    else:
+        url, comptes = demarrer_application(args), args.comptes
+
+    mesurer_niveau(url, preparer_requetes(corpus, endpoints, args.echauffement, comptes, args.graine),
+                   max(niveaux), args.audio)
+
+    resultats = []
+    for concurrence in niveaux:
+        requetes = preparer_requetes(corpus, endpoints, args.requetes, comptes, args.graine + concurrence)
+        niveau = mesurer_niveau(url, requetes, concurrence, args.audio)
+        afficher_niveau(niveau)
+        resultats.append(niveau)
+
+    os.makedirs(os.path.dirname(sortie), exist_ok=True)
+    with open(sortie, "w", encoding="utf-8") as f:
+        json.dump({
+            "commit": commit,
+            "date": datetime.now().isoformat(),
+            "parametres": {cle: valeur for cle, valeur in vars(args).items() if cle != "comparer"},
+            "niveaux": resultats,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Résultats : {sortie}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Backend lancé par bench/charge.py dans son propre processus
+Installe la synthèse vocale factice, crée les comptes de test dans le dossier courant puis sert
+l'application avec le serveur werkzeug multi-thread : le client de charge ne partage ni
+l'interpréteur ni le GIL du serveur mesuré.
+
+Usage : OLLAMA_URL=http://127.0.0.1:11435 python bench/serveur_charge.py --port 5050 --comptes 20 --latence-tts 0.3
+"""
+
+import os
+import sys
+import argparse
+
+DOSSIER_BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DOSSIER_BENCH)
+sys.path.insert(0, os.path.dirname(DOSSIER_BENCH))
+
+from stub_tts import installer_stub_tts  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--comptes", type=int, default=20, help="comptes de test charge0..chargeN-1")
+    parser.add_argument("--latence-tts", type=float, default=0.3, help="synthèse factice : durée par réponse (s)")
+    args = parser.parse_args()
+
+    import app
+    installer_stub_tts(app, args.latence_tts)
+
+    for i in range(args.comptes):
+        compte = dict(app.donnees_par_defaut()["users"]["default"], solde_principal=10**12, transactions=[])
+        app.depot.creer(f"charge{i}", compte)
+    app.depot.ecrire_modifies()
+
+    from werkzeug.serving import make_server
+    make_server("127.0.0.1", args.port, app.app, threaded=True).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Serveur HTTP local imitant l'API Ollama (/api/generate, /api/tags)
+Permet de tester le repli LLM et le flux /process/stream sans modèle.
+
+Usage : python bench/stub_ollama.py --port 11435 --latence-premier 0.3 --latence-token 0.05
+puis lancer le backend avec OLLAMA_URL=http://localhost:11435
+"""
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPONSE_DEFAUT = ("Pour retirer de l'argent, rendez-vous chez un point marchand Orange Money. "
+                  "Composez le code de retrait et confirmez avec votre code secret. "
+                  "Le marchand vous remet ensuite les espèces.")
+
+class GestionnaireOllama(BaseHTTPRequestHandler):
+    """Répond comme Ollama, avec des latences configurables"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _envoyer_json(self, donnees, statut=200):
+        corps = json.dumps(donnees, ensure_ascii=False).encode("utf-8")
+        self.send_response(statut)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._envoyer_json({"models": [{"name": self.server.modele}]})
+        else:
+            self._envoyer_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self._envoyer_json({"error": "not found"}, 404)
+            return
+
+        longueur = int(self.headers.get("Content-Length", 0))
+        requete = json.loads(self.rfile.read(longueur) or b"{}")
+        modele = requete.get("model", self.server.modele)
+        # Découpage en jetons approximatif : un mot et son espace
+        jetons = [mot + " " for mot in self.server.reponse.split(" ")]
+        jetons[-1] = jetons[-1].rstrip()
+
+        time.sleep(self.server.latence_premier)
+
+        if not requete.get("stream", True):
+            time.sleep(self.server.latence_token * len(jetons))
+            self._envoyer_json({"model": modele, "response": "".join(jetons), "done": True})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, jeton in enumerate(jetons):
+            if i:
+                time.sleep(self.server.latence_token)
+            self._envoyer_morceau({"model": modele, "response": jeton, "done": False})
+        self._envoyer_morceau({"model": modele, "response": "", "done": True})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _envoyer_morceau(self, donnees):
+        ligne = (json.dumps(donnees, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(ligne):x}\r\n".encode() + ligne + b"\r\n")
+        self.wfile.flush()
+
+def demarrer_stub_ollama(port=0, latence_premier=0.0, latence_token=0.0,
+                         reponse=REPONSE_DEFAUT, modele="gemma:2b"):
+    """Démarre le serveur dans un thread ; retourne le serveur (server.server_port)"""
+    serveur = ThreadingHTTPServer(("127.0.0.1", port), GestionnaireOllama)
+    serveur.daemon_threads = True
+    serveur.latence_premier = latence_premier
+    serveur.latence_token = latence_token
+    serveur.reponse = reponse
+    serveur.modele = modele
+    threading.Thread(target=serveur.serve_forever, name="stub-ollama", daemon=True).start()
+    return serveur
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latence-premier", type=float, default=0.3, help="délai avant le premier jeton (s)")
+    parser.add_argument("--latence-token", type=float, default=0.05, help="délai entre deux jetons (s)")
+    args = parser.parse_args()
+
+    serveur = demarrer_stub_ollama(args.port, args.latence_premier, args.latence_token)
+    print(f"Stub Ollama sur http://127.0.0.1:{serveur.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        serveur.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Synthèse vocale factice pour les benchmarks
+Remplace les moteurs de synthèse du module app par un moteur qui attend une durée configurable puis
+écrit un mp3 silencieux : la charge mesurée ne dépend ni du réseau ni d'un moteur installé.
+"""
+
+import time
+
+# Trame MPEG-1 Layer III 128 kb/s 44,1 kHz vide (en-tête + remplissage) : 26 ms de silence
+TRAME_MP3 = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+class MoteurFactice:
+    """Moteur au même contrat que ceux de app.MOTEURS_TTS"""
+
+    nom = "factice"
+
+    def __init__(self, latence, trames):
+        self.latence = latence
+        self.trames = trames
+
+    def disponible(self):
+        return True
+
+    def synthetiser(self, texte, chemin):
+        time.sleep(self.latence)
+        with open(chemin, "wb") as f:
+            f.write(TRAME_MP3 * self.trames)
+
+def installer_stub_tts(module_app, latence=0.3, trames=40):
+    """Remplace les moteurs de synthèse du module app ; latence en secondes par réponse"""
+    moteur = MoteurFactice(latence, trames)
+    module_app.moteurs_tts[:] = [moteur]
+    return moteur
@@ -0,0 +1,38 @@
+"""
+Configuration gunicorn du mode multi-processus
+Les modèles sont chargés une seule fois dans le processus maître puis partagés en
+copie-sur-écriture avec les workers forkés ; les comptes passent en STORAGE_MODE=partage.
+
+Usage : gunicorn app:app   (ce fichier est lu automatiquement depuis le dossier courant)
+"""
+
+import gc
+import os
+import multiprocessing
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+# Threads par worker : les requêtes passent l'essentiel de leur temps à attendre Ollama ou la synthèse
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", "8"))
+# L'application est importée avant le fork : modèles et fragments audio déjà en mémoire.
+# Les threads de fond (journal, éviction audio, pool de synthèse) sont relancés dans chaque worker
+# par os.register_at_fork
+preload_app = True
+timeout = int(os.environ.get("WORKER_TIMEOUT", "60"))
+
+# Plusieurs processus écrivent les comptes : journal et écriture différée sont exclus
+if workers > 1:
+    os.environ["STORAGE_MODE"] = "partage"
+
+def when_ready(server):
+    """Appelé dans le maître avant le lancement des workers"""
+    import app
+    # Le préchargement a démarré en arrière-plan à l'import : on attend qu'il soit terminé
+    for nom in app.MODELES_PRECHARGES:
+        app.modeles.obtenir(nom)
+    # Les objets des modèles ne seront plus parcourus par le ramasse-miettes : leurs pages
+    # restent partagées au lieu d'être recopiées dans chaque worker
+    gc.freeze()
+    server.log.info(f"Modèles prêts ({', '.join(app.MODELES_PRECHARGES) or 'aucun'}), "
+                    f"{server.cfg.workers} workers en mode {app.STORAGE_MODE}")